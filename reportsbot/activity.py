@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+"""
+This module contains a bulk service for checking whether users are active.
+"""
+
+from datetime import datetime, timedelta
+from threading import Lock
+
+from .util import chunked, to_wiki_format
+
+__all__ = ["UserActivity"]
+
+class UserActivity:
+    """Checks whether users have edited recently, many users at a time.
+
+    Usernames are resolved to actor IDs, and recent changes are then looked
+    up with chunked IN lists of actors and a raw rc_timestamp range, which
+    together use the (rc_actor, rc_timestamp) index. A user is active if they
+    have made at least one edit in the past *days* days. Answers are kept in
+    memory for the life of this object.
+    """
+    CHUNKSIZE = 1000
+    TIMESTAMP_FORMAT = "%Y%m%d%H%M%S"
+
+    def __init__(self, bot, days=30):
+        self._bot = bot
+        self._days = days
+        self._memo = {}
+        self._lock = Lock()
+
+    def _get_actor_ids(self, cursor, names):
+        """Return a dict mapping actor IDs to the given usernames.
+
+        Users without an actor row have never edited, and are left out.
+        """
+        query = """SELECT actor_id, actor_name
+            FROM actor
+            WHERE actor_name IN ({})"""
+
+        actors = {}
+        for chunk in chunked(names, self.CHUNKSIZE):
+            cursor.execute(query.format(", ".join("?" * len(chunk))), chunk)
+            actors.update((actorid, name.decode("utf8"))
+                          for (actorid, name) in cursor.fetchall())
+        return actors
+
+    def _lookup(self, names):
+        """Return the subset of the given usernames that are active."""
+        query = """SELECT DISTINCT rc_actor
+            FROM recentchanges_userindex
+            WHERE rc_actor IN ({}) AND rc_timestamp > ?"""
+
+        since = datetime.utcnow() - timedelta(days=self._days)
+        stamp = since.strftime(self.TIMESTAMP_FORMAT)
+
+        active = set()
+        with self._bot.wikidb as cursor:
+            actors = self._get_actor_ids(cursor, names)
+            for chunk in chunked(list(actors), self.CHUNKSIZE):
+                cursor.execute(query.format(", ".join("?" * len(chunk))),
+                               chunk + [stamp])
+                active.update(actors[actorid]
+                              for (actorid,) in cursor.fetchall())
+        return active
+
+    def check(self, names):
+        """Return the subset of the given usernames that are active.
+
+        Names are normalized first, so the returned names may differ from the
+        given ones in capitalization and underscores.
+        """
+        names = {to_wiki_format(self._bot.site, name, ignore_ns=True)
+                 for name in names}
+        with self._lock:
+            active = {name for name in names if self._memo.get(name)}
+            unknown = [name for name in names if name not in self._memo]
+
+        if unknown:
+            found = self._lookup(unknown)
+            with self._lock:
+                for name in unknown:
+                    self._memo[name] = name in found
+            active |= found
+        return active
+
+    def is_active(self, name):
+        """Return whether the given user is active."""
+        name = to_wiki_format(self._bot.site, name, ignore_ns=True)
+        return name in self.check([name])
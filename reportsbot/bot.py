@@ -1,15 +1,25 @@
 # -*- coding: utf-8 -*-
 
+from collections.abc import Mapping
 from datetime import datetime
 import encodings
+from functools import partial
 import json
 from os.path import expanduser
 import re
+from threading import Lock
+from types import MappingProxyType
 
 import oursql
 
+from .activity import UserActivity
+from .categories import CategoryCrawler
+from .creation import CreationDates
+from .existence import ExistenceChecker
+from .pool import ConnectionPool
+from .publish import Publisher
 from .user import User
-from .util import to_wiki_format
+from .util import chunked, split_full_title, to_wiki_format
 from .wikidata import Wikidata
 from .wikiproject import WikiProject
 
@@ -22,7 +32,11 @@ class Bot:
     attribute, and is their primary way of interacting with the external world.
     It provides access to databases and structured representations of many
     objects like WikiProjects and users.
+
+    Database connections come from per-database pools. Each thread gets its
+    own connection, so tasks may run queries from several threads at once.
     """
+    PROJECT_FEATURES = ("metrics", "new_discussions")
 
     def __init__(self, config, project, lang):
         self._config = config
@@ -30,10 +44,17 @@ class Bot:
         self._lang = lang
 
         self._site = None
-        self._wikidb = None
-        self._localdb = None
+        self._pools = {}
+        self._pool_lock = Lock()
         self._wikidata = None
+        self._creation_dates = None
+        self._categories = None
+        self._existence = None
+        self._publisher = None
+        self._activity = None
+        self._pages = {}
         self._project_config = None
+        self._project_features = None
 
     @staticmethod
     def _register_utf8mb4():
@@ -70,11 +91,52 @@ class Bot:
 
         return oursql.connect(**kwargs)
 
+    def _get_pool(self, name):
+        """Return the connection pool for the given database, creating it."""
+        with self._pool_lock:
+            if name not in self._pools:
+                if name == "local":
+                    kwargs = self._config.get_local_sql()
+                else:
+                    kwargs = self._config.get_wiki_sql(name)
+                self._pools[name] = ConnectionPool(
+                    partial(self._sql_connect, **kwargs),
+                    size=self._config.sql_pool_size)
+            return self._pools[name]
+
+    @classmethod
+    def _freeze(cls, value):
+        """Return a read-only copy of a value loaded from JSON."""
+        if isinstance(value, dict):
+            return MappingProxyType(
+                {key: cls._freeze(item) for key, item in value.items()})
+        if isinstance(value, list):
+            return tuple(cls._freeze(item) for item in value)
+        return value
+
+    @staticmethod
+    def _has_feature(config, feature):
+        """Return whether the given project config enables a feature.
+
+        A feature is enabled if its setting is true, or if it is a group of
+        settings whose "enabled" setting is true.
+        """
+        value = config.get(feature)
+        if isinstance(value, Mapping):
+            return bool(value.get("enabled"))
+        return bool(value)
+
     def _load_project_config(self):
         """Load the project config JSON blob from the database.
 
-        After calling this function, the config is available from and cached in
-        self._project_config.
+        Each project's config is merged with the defaults and frozen once, so
+        lookups are a single dict access and every caller shares the same
+        read-only mapping. Project names are normalized, and the names of
+        projects with each of PROJECT_FEATURES enabled are indexed.
+
+        After calling this function, the configs are available from and cached
+        in self._project_config, and the feature index in
+        self._project_features.
         """
         if self._project_config is not None:
             return
@@ -83,31 +145,30 @@ class Bot:
         with self.localdb as cursor:
             cursor.execute(query, (self.wikiid,))
             results = cursor.fetchall()
-            if not results:
-                self._project_config = {"defaults": {}, "projects": {}}
-                return
-            raw = json.loads(results[0][0])
-
-        config = {"defaults": raw["defaults"], "projects": {}}
-        for project in raw["projects"]:
-            config["projects"][project["name"]] = project
-        self._project_config = config
+        raw = json.loads(results[0][0]) if results else {}
+
+        defaults = raw.get("defaults", {})
+        projects = {}
+        for project in raw.get("projects", []):
+            config = defaults.copy()
+            config.update(project)
+            name = to_wiki_format(self.site, project["name"])
+            projects[name] = self._freeze(config)
+
+        self._project_features = MappingProxyType({
+            feature: tuple(name for name, config in projects.items()
+                           if self._has_feature(config, feature))
+            for feature in self.PROJECT_FEATURES})
+        self._project_config = MappingProxyType(projects)
 
     def _get_project_config(self, name):
         """Return the on-wiki JSON configuration for the given project.
 
-        Default values are automatically resolved. If the project doesn't
-        exist, None is returned.
+        Default values are automatically resolved. The result is a read-only
+        mapping. If the project doesn't exist, None is returned.
         """
         self._load_project_config()
-
-        name = to_wiki_format(self.site, name)
-        if name not in self._project_config["projects"]:
-            return None
-
-        config = self._project_config["defaults"].copy()
-        config.update(self._project_config["projects"][name])
-        return config
+        return self._project_config.get(to_wiki_format(self.site, name))
 
     @property
     def config(self):
@@ -135,33 +196,133 @@ class Bot:
 
     @property
     def wikidb(self):
-        """Return a connection to the wiki replica SQL database."""
-        if not self._wikidb:
-            kwargs = self._config.get_wiki_sql(self.wikiid)
-            self._wikidb = self._sql_connect(**kwargs)
-        return self._wikidb
+        """Return the current thread's connection to the wiki replica DB."""
+        return self._get_pool(self.wikiid).get()
 
     @property
     def localdb(self):
-        """Return a connection to the local Reports bot/WPX SQL database."""
-        if not self._localdb:
-            self._localdb = self._sql_connect(**self._config.get_local_sql())
-        return self._localdb
+        """Return the current thread's connection to the local WPX DB."""
+        return self._get_pool("local").get()
 
     @property
     def wikidata(self):
         """Return an interface to Wikidata."""
         if not self._wikidata:
-            sql_kwargs = self._config.get_wiki_sql("wikidatawiki")
-            sql_conn = self._sql_connect(**sql_kwargs)
-            self._wikidata = Wikidata(self.site, sql_conn)
+            pool = self._get_pool("wikidatawiki")
+            self._wikidata = Wikidata(self.site, pool)
         return self._wikidata
 
+    @property
+    def creation_dates(self):
+        """Return a cached lookup of page creation timestamps."""
+        if not self._creation_dates:
+            self._creation_dates = CreationDates(self)
+        return self._creation_dates
+
+    @property
+    def categories(self):
+        """Return a crawler for finding pages within category trees."""
+        if not self._categories:
+            self._categories = CategoryCrawler(self)
+        return self._categories
+
+    @property
+    def existence(self):
+        """Return a cached checker for whether pages exist."""
+        if not self._existence:
+            self._existence = ExistenceChecker(self)
+        return self._existence
+
+    @property
+    def publisher(self):
+        """Return a layer for saving reports that skips no-op edits."""
+        if not self._publisher:
+            self._publisher = Publisher(self)
+        return self._publisher
+
+    @property
+    def activity(self):
+        """Return a bulk checker for whether users have edited recently."""
+        if not self._activity:
+            self._activity = UserActivity(self)
+        return self._activity
+
+    @property
+    def pool_stats(self):
+        """Return a dict mapping database names to connection pool stats."""
+        with self._pool_lock:
+            pools = list(self._pools.items())
+        return {name: pool.stats for (name, pool) in pools}
+
+    def release_connections(self):
+        """Return the current thread's database connections to their pools.
+
+        Worker threads should call this when they are done with the database.
+        Connections are also released automatically when a thread exits.
+        """
+        with self._pool_lock:
+            pools = list(self._pools.values())
+        for pool in pools:
+            pool.release_thread()
+
     def get_page(self, title):
-        """Return a Pywikibot Page instance for the given page."""
+        """Return a Pywikibot Page instance for the given page.
+
+        If the page was loaded by prefetch_pages(), the same instance is
+        returned, and its text is available without another API request.
+        """
         import pywikibot
+        if title in self._pages:
+            return self._pages[title]
         return pywikibot.Page(self.site, title)
 
+    def prefetch_pages(self, titles, groupsize=50):
+        """Load the content of the given pages in bulk, for get_page().
+
+        Tasks should call this with the titles of all the pages they expect to
+        read before reading them. Pages are fetched *groupsize* at a time,
+        which is the API's limit for most accounts.
+        """
+        import pywikibot
+        pages = {title: pywikibot.Page(self.site, title) for title in titles
+                 if title not in self._pages}
+        if not pages:
+            return
+
+        for _ in self.site.preloadpages(list(pages.values()),
+                                        groupsize=groupsize):
+            pass
+        self._pages.update(pages)
+
+    def clear_page_cache(self):
+        """Forget all pages loaded by prefetch_pages()."""
+        self._pages.clear()
+
+    def get_latest_revisions(self, titles):
+        """Return a dict mapping the given page titles to their latest revids.
+
+        The revision IDs come from the wiki replica, so they may lag slightly
+        behind the live site. Pages that don't exist are left out.
+        """
+        query = """SELECT page_title, page_latest
+            FROM page
+            WHERE page_namespace = ? AND page_title IN ({})"""
+
+        bynamespace = {}
+        for title in titles:
+            ns, sqltitle = split_full_title(self.site, title)
+            bynamespace.setdefault(ns, {})[sqltitle] = title
+
+        revids = {}
+        with self.wikidb as cursor:
+            for ns, nstitles in bynamespace.items():
+                for chunk in chunked(list(nstitles), 1000):
+                    cursor.execute(query.format(", ".join("?" * len(chunk))),
+                                   [ns] + chunk)
+                    for sqltitle, revid in cursor.fetchall():
+                        revids[nstitles[sqltitle.decode("utf8")]] = revid
+        return revids
+
     def get_project(self, name):
         """Return a WikiProject object corresponding to the given name.
 
@@ -174,11 +335,19 @@ class Bot:
         """Return a User object corresponding to the given username."""
         return User(self, name)
 
-    def get_configured_projects(self):
-        """Return a list of all WikiProjects that are configured."""
+    def get_configured_projects(self, feature=None):
+        """Return a list of all WikiProjects that are configured.
+
+        If *feature* is given, it should be one of PROJECT_FEATURES, and only
+        projects with that feature enabled are returned.
+        """
         self._load_project_config()
-        projects = self._project_config["projects"]
-        return [self.get_project(name) for name in projects]
+        if feature is None:
+            names = self._project_config
+        else:
+            names = self._project_features[feature]
+        return [WikiProject(self, name, self._project_config[name])
+                for name in names]
 
     def get_last_updated(self, key):
         """Get the last update timestamp for the given key."""
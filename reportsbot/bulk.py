@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+"""
+This module contains helpers for writing large amounts of data to SQL.
+"""
+
+from collections import OrderedDict
+from tempfile import NamedTemporaryFile
+from threading import Lock
+from time import time
+
+from .util import chunked
+
+__all__ = ["BulkWriter"]
+
+_stats_lock = Lock()
+
+class BulkWriter:
+    """Writes rows to a database using as few round trips as possible.
+
+    Rows are inserted with multi-row INSERT statements, or staged into
+    temporary tables that can be joined against for set-based UPDATEs and
+    DELETEs. If *infile* is True, staging uses LOAD DATA LOCAL INFILE from a
+    spooled file instead; this requires the connection to have been opened
+    with local_infile enabled.
+
+    The number of rows and the time spent are recorded for each named phase.
+    If a *stats* dict is given, totals are accumulated in it, which allows a
+    task to report on several writers at once, even across threads.
+
+    Use as a context manager to drop staged tables when finished.
+    """
+
+    def __init__(self, cursor, infile=False, batchsize=1000, stats=None):
+        self._cursor = cursor
+        self._infile = infile
+        self._batchsize = batchsize
+        self._stats = stats if stats is not None else OrderedDict()
+        self._staged = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @staticmethod
+    def _escape_infile_value(value):
+        """Return the given value encoded for a LOAD DATA file."""
+        if value is None:
+            return r"\N"
+        if isinstance(value, bool):
+            return str(int(value))
+        if isinstance(value, bytes):
+            value = value.decode("utf8")
+        return (str(value).replace("\\", "\\\\").replace("\t", "\\t")
+                .replace("\n", "\\n"))
+
+    def _record(self, phase, rows, start):
+        """Record that a phase processed some rows starting at a time."""
+        elapsed = time() - start
+        with _stats_lock:
+            if phase not in self._stats:
+                self._stats[phase] = [0, 0.0]
+            self._stats[phase][0] += rows
+            self._stats[phase][1] += elapsed
+
+    @property
+    def stats(self):
+        """Return a dict mapping phase names to [rows, seconds] pairs."""
+        return self._stats
+
+    def _insert_rows(self, table, columns, rows):
+        """Insert rows into a table with multi-row INSERT statements."""
+        query = "INSERT INTO {} ({}) VALUES ".format(table, ", ".join(columns))
+        clause = "(" + ", ".join("?" * len(columns)) + ")"
+
+        for batch in chunked(rows, self._batchsize):
+            args = [arg for row in batch for arg in row]
+            self._cursor.execute(query + ", ".join([clause] * len(batch)),
+                                 args)
+
+    def _load_infile(self, table, columns, rows):
+        """Load rows into a table using LOAD DATA LOCAL INFILE."""
+        query = r"""LOAD DATA LOCAL INFILE '{}' INTO TABLE {}
+            CHARACTER SET utf8mb4
+            FIELDS TERMINATED BY '\t' ESCAPED BY '\\'
+            LINES TERMINATED BY '\n'
+            ({})"""
+
+        with NamedTemporaryFile("w", encoding="utf8", suffix=".tsv") as fp:
+            for row in rows:
+                fp.write("\t".join(self._escape_infile_value(value)
+                                   for value in row) + "\n")
+            fp.flush()
+            query = query.format(fp.name, table, ", ".join(columns))
+            self._cursor.execute(query, plain_query=True)
+
+    def insert(self, table, columns, rows, phase=None):
+        """Insert the given rows into a table with multi-row statements.
+
+        *columns* is a list of column names, and *rows* is a list of tuples
+        with matching values.
+        """
+        start = time()
+        rows = list(rows)
+        self._insert_rows(table, columns, rows)
+        self._record(phase or "insert " + table, len(rows), start)
+
+    def stage(self, name, columns, rows, phase=None):
+        """Load rows into a new temporary table, and return its name.
+
+        *columns* is a list of (name, type) tuples, like
+        [("id", "INT UNSIGNED NOT NULL")]. The table is dropped when the
+        writer is closed.
+        """
+        start = time()
+        rows = list(rows)
+
+        query = "CREATE TEMPORARY TABLE {} ({})".format(
+            name, ", ".join(col + " " + type_ for (col, type_) in columns))
+        self._cursor.execute("DROP TEMPORARY TABLE IF EXISTS " + name)
+        self._cursor.execute(query)
+        if name not in self._staged:
+            self._staged.append(name)
+
+        colnames = [col for (col, _) in columns]
+        if self._infile and rows:
+            self._load_infile(name, colnames, rows)
+        else:
+            self._insert_rows(name, colnames, rows)
+
+        self._record(phase or "stage " + name, len(rows), start)
+        return name
+
+    def execute(self, query, args=(), phase=None):
+        """Execute a set-based statement and record the rows it affected."""
+        phase = phase or query.split(None, 1)[0].lower()
+        start = time()
+        self._cursor.execute(query, args)
+        rows = self._cursor.rowcount
+        self._record(phase, rows if rows and rows > 0 else 0, start)
+
+    def close(self):
+        """Drop any temporary tables created by this writer."""
+        for name in self._staged:
+            self._cursor.execute("DROP TEMPORARY TABLE IF EXISTS " + name)
+        self._staged = []
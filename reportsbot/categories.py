@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+"""
+This module contains a crawler for the category graph of a wiki.
+"""
+
+from datetime import datetime, timedelta
+
+from .bulk import BulkWriter
+from .util import chunked, to_sql_format
+
+__all__ = ["CategoryCrawler"]
+
+class CategoryCrawler:
+    """Finds the pages within categories and all of their subcategories.
+
+    The category graph is walked breadth-first from each root category, one
+    depth level at a time. Each level is fetched with a few chunked queries,
+    and categories already visited are skipped, so cycles and diamonds in the
+    graph are harmless.
+
+    The page IDs found under each root are cached in the local database, and
+    reused for *ttl* as long as the same depth and namespaces are asked for.
+    """
+    CHUNKSIZE = 1000
+    MAX_DEPTH = 20
+    TTL = timedelta(hours=12)
+
+    def __init__(self, bot, ttl=None):
+        self._bot = bot
+        self._ttl = ttl if ttl is not None else self.TTL
+
+    def _crawl(self, root, namespaces, max_depth):
+        """Return a set of page IDs within the given category, recursively.
+
+        Only pages in the given namespaces are included. Subcategories deeper
+        than *max_depth* levels below the root are not visited.
+        """
+        query = """SELECT page_id, page_namespace,
+            IF(page_namespace = 14, page_title, NULL)
+        FROM categorylinks
+        JOIN page ON page_id = cl_from
+        WHERE cl_to IN ({})
+        AND page_namespace IN ({})
+        AND page_is_redirect = 0"""
+
+        wanted = set(namespaces)
+        searched = sorted(wanted | {14})
+        pages = set()
+        visited = {root}
+        frontier = [root]
+        depth = 0
+
+        with self._bot.wikidb as cursor:
+            while frontier:
+                subcats = []
+                for chunk in chunked(frontier, self.CHUNKSIZE):
+                    cursor.execute(query.format(
+                        ", ".join("?" * len(chunk)),
+                        ", ".join("?" * len(searched))), chunk + searched)
+
+                    for pageid, ns, title in cursor.fetchall():
+                        if ns in wanted:
+                            pages.add(pageid)
+                        if ns == 14:
+                            title = title.decode("utf8")
+                            if title not in visited:
+                                visited.add(title)
+                                subcats.append(title)
+
+                depth += 1
+                frontier = subcats if depth <= max_depth else []
+
+        return pages
+
+    def _load_cached(self, root, namespaces, max_depth):
+        """Return the cached page IDs for the given root, or None."""
+        query1 = """SELECT cc_timestamp FROM category_cache
+            WHERE cc_site = ? AND cc_category = ? AND cc_depth = ?
+            AND cc_namespaces = ?"""
+        query2 = """SELECT cm_page FROM category_members
+            WHERE cm_site = ? AND cm_category = ?"""
+
+        with self._bot.localdb as cursor:
+            cursor.execute(query1, (self._bot.wikiid, root, max_depth,
+                                    namespaces))
+            results = cursor.fetchall()
+            if not results:
+                return None
+            if results[0][0] < datetime.utcnow() - self._ttl:
+                return None
+
+            cursor.execute(query2, (self._bot.wikiid, root))
+            return {pageid for (pageid,) in cursor.fetchall()}
+
+    def _store(self, root, namespaces, max_depth, pages):
+        """Replace the cached page IDs for the given root."""
+        query1 = """DELETE FROM category_members
+            WHERE cm_site = ? AND cm_category = ?"""
+        query2 = """INSERT INTO category_cache
+            (cc_site, cc_category, cc_depth, cc_namespaces, cc_timestamp)
+            VALUES (?, ?, ?, ?, ?)
+            ON DUPLICATE KEY UPDATE cc_depth = VALUES(cc_depth),
+            cc_namespaces = VALUES(cc_namespaces),
+            cc_timestamp = VALUES(cc_timestamp)"""
+
+        site = self._bot.wikiid
+        rows = [(site, root, pageid) for pageid in sorted(pages)]
+        with self._bot.localdb as cursor:
+            cursor.execute(query1, (site, root))
+            with BulkWriter(cursor) as writer:
+                writer.insert("category_members",
+                              ["cm_site", "cm_category", "cm_page"], rows)
+            cursor.execute(query2, (site, root, max_depth, namespaces,
+                                    datetime.utcnow()))
+
+    def _get_titles(self, pageids):
+        """Return a dict mapping the given page IDs to (ns, title) pairs.
+
+        Pages that have since been deleted or turned into redirects are left
+        out.
+        """
+        query = """SELECT page_id, page_namespace, page_title
+        FROM page
+        WHERE page_id IN ({}) AND page_is_redirect = 0"""
+
+        pages = {}
+        with self._bot.wikidb as cursor:
+            for chunk in chunked(sorted(pageids), self.CHUNKSIZE):
+                cursor.execute(query.format(", ".join("?" * len(chunk))),
+                               chunk)
+                pages.update((pageid, (ns, title.decode("utf8")))
+                             for (pageid, ns, title) in cursor.fetchall())
+        return pages
+
+    def get_page_ids(self, root, namespaces=(0,), max_depth=None):
+        """Return a set of page IDs within the given category, recursively.
+
+        *root* is a category name without the namespace prefix. Only pages in
+        the given namespaces are included.
+        """
+        root = to_sql_format(root)
+        if max_depth is None:
+            max_depth = self.MAX_DEPTH
+        nskey = ",".join(str(ns) for ns in sorted(namespaces))
+
+        pages = self._load_cached(root, nskey, max_depth)
+        if pages is None:
+            pages = self._crawl(root, namespaces, max_depth)
+            self._store(root, nskey, max_depth, pages)
+        return pages
+
+    def get_members(self, roots, namespaces=(0,), max_depth=None):
+        """Return the pages within the given categories, recursively.
+
+        The result is a dict mapping page IDs to (ns, title) pairs. Redirects
+        are not included.
+        """
+        pageids = set()
+        for root in roots:
+            pageids |= self.get_page_ids(root, namespaces, max_depth)
+        return self._get_titles(pageids)
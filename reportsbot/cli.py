@@ -9,7 +9,7 @@ from argparse import ArgumentParser
 from .config import Config
 from .exceptions import TaskLoaderError
 from .logging import setup_logging
-from .runner import find_task, run_task
+from .runner import find_task, run_tasks, run_on_wikis
 
 __all__ = ["run"]
 
@@ -24,7 +24,8 @@ def run(task_dir=".", config_dir="config", log_dir=None):
     """
     parser = ArgumentParser(
         description="Run tasks through the Reports bot.", add_help=False,
-        usage="%(prog)s [-p <project>] [-l <lang>] [-q] <task> [<task> ...]")
+        usage="%(prog)s [-p <project>] [-l <lang>] [-w <wikis>] [-q] "
+              "<task> [<task> ...]")
 
     g_task = parser.add_argument_group("task options")
     g_task.add_argument("task_names", nargs="+", metavar="<task>",
@@ -35,6 +36,16 @@ def run(task_dir=".", config_dir="config", log_dir=None):
     g_task.add_argument("-l", "--lang", metavar="<lang>",
                         help="""language to run the bot on (default: en, unless
                         overridden in config)""")
+    g_task.add_argument("-w", "--wikis", metavar="<wikis>",
+                        help="""comma-separated list of wikis to run the tasks
+                        on in parallel, like "en.wikipedia,de.wikipedia"; use
+                        "all" for every wiki listed in config""")
+    g_task.add_argument("--no-deps", action="store_true",
+                        help="""don't run prerequisite tasks; run the given
+                        tasks in order""")
+    g_task.add_argument("-j", "--jobs", metavar="<n>", type=int,
+                        help="""maximum number of wikis to run at once with
+                        -w (default: number of CPUs)""")
 
     g_logs = parser.add_argument_group("logging")
     g_logs.add_argument("-q", "--quiet", action="store_true",
@@ -60,8 +71,29 @@ def run(task_dir=".", config_dir="config", log_dir=None):
     except TaskLoaderError:
         exit(1)
 
-    for task in tasks:
-        run_task(task, config, project=args.project, lang=args.lang)
+    if args.wikis:
+        if args.wikis == "all":
+            wikis = config.wikis
+        else:
+            wikis = [tuple(wiki.split(".", 1))
+                     for wiki in args.wikis.split(",")]
+        if not wikis or any(len(wiki) != 2 for wiki in wikis):
+            parser.error("invalid wiki list: " + args.wikis)
+
+        log_dir = None if args.traceless else args.log_dir
+        ok = run_on_wikis(args.task_names, task_dir, config, wikis,
+                          jobs=args.jobs, log_dir=log_dir, quiet=args.quiet,
+                          deps=not args.no_deps)
+        exit(0 if ok else 1)
+
+    try:
+        results = run_tasks(tasks, config, project=args.project,
+                            lang=args.lang, task_dir=task_dir,
+                            deps=not args.no_deps)
+    except TaskLoaderError:
+        exit(1)
+    if any(status in ("failed", "blocked") for (_, status, _) in results):
+        exit(1)
 
 if __name__ == "__main__":
     run()
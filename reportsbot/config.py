@@ -41,6 +41,17 @@ class Config:
         """Return the bot's config directory."""
         return self._base_dir
 
+    @property
+    def cache_dir(self):
+        """Return the directory used for persistent task caches."""
+        root = path.dirname(path.abspath(self._base_dir))
+        return self._data.get("cache_dir", path.join(root, "cache"))
+
+    @property
+    def sql_pool_size(self):
+        """Return the maximum number of connections to open per database."""
+        return self._data.get("sql", {}).get("pool_size", 8)
+
     @property
     def username(self):
         """Return the bot's username."""
@@ -56,6 +67,23 @@ class Config:
         """Return the default site language, like 'en'."""
         return self._data.get("defaults", {}).get("lang", "en")
 
+    @property
+    def wikis(self):
+        """Return a list of (lang, project) tuples for all configured wikis.
+
+        These are given in config.yml as strings like "en.wikipedia".
+        """
+        wikis = self._data.get("wikis", [])
+        return [tuple(wiki.split(".", 1)) for wiki in wikis]
+
+    def get_task_config(self, task):
+        """Return a dict of bot-side settings for the given task.
+
+        These come from the task's entry in the "tasks" section of config.yml,
+        and are distinct from the on-wiki project configuration.
+        """
+        return self._data.get("tasks", {}).get(task, {})
+
     def get_wiki_sql(self, site):
         """Return SQL connection info for the wiki DB for the given site."""
         info = self._get_sql_info("wiki")
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+"""
+This module contains a persistent cache of page creation timestamps.
+"""
+
+from threading import Lock
+
+from .util import chunked
+
+__all__ = ["CreationDates"]
+
+class CreationDates:
+    """Looks up when pages were created, by page ID.
+
+    A page's creation timestamp (the timestamp of its first revision) never
+    changes, so each one is looked up on the wiki replica only once and then
+    stored in the local page_creation table. Timestamps are also kept in
+    memory for the life of this object.
+
+    Timestamps are strings in MediaWiki's YYYYMMDDHHMMSS format.
+    """
+    CHUNKSIZE = 5000
+
+    def __init__(self, bot):
+        self._bot = bot
+        self._memo = {}
+        self._lock = Lock()
+
+    def _load_cached(self, pageids):
+        """Return a dict of timestamps for the given pages from the cache."""
+        query = """SELECT pc_page, pc_timestamp
+            FROM page_creation
+            WHERE pc_site = ? AND pc_page IN ({})"""
+
+        timestamps = {}
+        with self._bot.localdb as cursor:
+            for chunk in chunked(pageids, self.CHUNKSIZE):
+                cursor.execute(query.format(", ".join("?" * len(chunk))),
+                               [self._bot.wikiid] + chunk)
+                timestamps.update((pageid, timestamp.decode("utf8"))
+                                  for (pageid, timestamp) in cursor.fetchall())
+        return timestamps
+
+    def _load_replica(self, pageids):
+        """Return a dict of timestamps for the given pages from the replica.
+
+        This is a loose scan of the (rev_page, rev_timestamp) index, reading
+        only the first revision of each page. Deleted pages are left out.
+        """
+        query = """SELECT rev_page, MIN(rev_timestamp)
+            FROM revision
+            WHERE rev_page IN ({})
+            GROUP BY rev_page"""
+
+        timestamps = {}
+        with self._bot.wikidb as cursor:
+            for chunk in chunked(pageids, self.CHUNKSIZE):
+                cursor.execute(query.format(", ".join("?" * len(chunk))),
+                               chunk)
+                timestamps.update((pageid, timestamp.decode("utf8"))
+                                  for (pageid, timestamp) in cursor.fetchall())
+        return timestamps
+
+    def _store(self, timestamps):
+        """Save the given timestamps to the cache."""
+        query = """INSERT IGNORE INTO page_creation
+            (pc_site, pc_page, pc_timestamp) VALUES {}"""
+
+        rows = sorted(timestamps.items())
+        with self._bot.localdb as cursor:
+            for chunk in chunked(rows, self.CHUNKSIZE):
+                args = [arg for (pageid, timestamp) in chunk
+                        for arg in (self._bot.wikiid, pageid, timestamp)]
+                cursor.execute(query.format(
+                    ", ".join(["(?, ?, ?)"] * len(chunk))), args)
+
+    def get(self, pageids):
+        """Return a dict mapping the given page IDs to creation timestamps.
+
+        Pages that don't exist (or were deleted) are left out.
+        """
+        with self._lock:
+            found = {pageid: self._memo[pageid] for pageid in pageids
+                     if pageid in self._memo}
+
+        missing = sorted(set(pageids) - found.keys())
+        cached = self._load_cached(missing) if missing else {}
+        missing = [pageid for pageid in missing if pageid not in cached]
+        fetched = self._load_replica(missing) if missing else {}
+        if fetched:
+            self._store(fetched)
+
+        with self._lock:
+            self._memo.update(cached)
+            self._memo.update(fetched)
+        found.update(cached)
+        found.update(fetched)
+        return found
+
+    def get_one(self, pageid):
+        """Return the creation timestamp of the given page, or None."""
+        return self.get([pageid]).get(pageid)
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+"""
+This module contains a cached service for checking whether pages exist.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+
+from .util import chunked, split_full_title
+
+__all__ = ["ExistenceChecker"]
+
+class ExistenceChecker:
+    """Checks whether pages exist using the wiki replica.
+
+    Titles are grouped by namespace and looked up with chunked IN lists
+    against the (namespace, title) index. Answers, both positive and negative,
+    are kept in an LRU cache of up to *size* titles.
+    """
+    CHUNKSIZE = 1000
+
+    def __init__(self, bot, size=100000):
+        self._bot = bot
+        self._size = size
+        self._cache = OrderedDict()
+        self._lock = Lock()
+
+    def _lookup(self, titles):
+        """Return the subset of the given titles that exist on the replica."""
+        query = """SELECT page_title
+            FROM page
+            WHERE page_namespace = ? AND page_title IN ({})"""
+
+        bynamespace = {}
+        for title in titles:
+            ns, sqltitle = split_full_title(self._bot.site, title)
+            bynamespace.setdefault(ns, {}).setdefault(sqltitle, []).append(
+                title)
+
+        found = set()
+        with self._bot.wikidb as cursor:
+            for ns, nstitles in bynamespace.items():
+                for chunk in chunked(list(nstitles), self.CHUNKSIZE):
+                    cursor.execute(query.format(", ".join("?" * len(chunk))),
+                                   [ns] + chunk)
+                    for (sqltitle,) in cursor.fetchall():
+                        found.update(nstitles[sqltitle.decode("utf8")])
+        return found
+
+    def _remember(self, titles, existing):
+        """Add the given titles to the cache, evicting old entries."""
+        with self._lock:
+            for title in titles:
+                self._cache[title] = title in existing
+                self._cache.move_to_end(title)
+            while len(self._cache) > self._size:
+                self._cache.popitem(last=False)
+
+    def check(self, titles):
+        """Return the subset of the given full page titles that exist."""
+        existing = set()
+        unknown = []
+        with self._lock:
+            for title in set(titles):
+                if title in self._cache:
+                    self._cache.move_to_end(title)
+                    if self._cache[title]:
+                        existing.add(title)
+                else:
+                    unknown.append(title)
+
+        if unknown:
+            found = self._lookup(unknown)
+            self._remember(unknown, found)
+            existing |= found
+        return existing
+
+    def missing(self, titles):
+        """Return the subset of the given full page titles that don't exist."""
+        return set(titles) - self.check(titles)
+
+    def exists(self, title):
+        """Return whether the given full page title exists."""
+        return title in self.check([title])
+
+    def forget(self, title):
+        """Drop any cached answer for the given title.
+
+        Call this after creating or deleting a page.
+        """
+        with self._lock:
+            self._cache.pop(title, None)
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+"""
+This module contains a thread-safe pool of SQL connections.
+"""
+
+from contextlib import contextmanager
+from threading import Condition, local
+from time import time
+import weakref
+
+__all__ = ["ConnectionPool"]
+
+class _Binding:
+    """Holds a connection bound to a single thread.
+
+    The connection is released back to its pool when the binding is garbage
+    collected (like when its thread exits), or when release() is called.
+    """
+
+    def __init__(self, pool, conn):
+        self.conn = conn
+        self.release = weakref.finalize(self, pool.release, conn)
+
+class ConnectionPool:
+    """A bounded, thread-safe pool of database connections.
+
+    Connections are created on demand by calling *connect*, up to *size* open
+    connections; beyond that, callers wait for one to be released. Idle
+    connections that haven't been used for *max_idle* seconds are pinged when
+    checked out, and replaced if they have gone away.
+
+    There are two ways to use the pool. get() returns a connection bound to
+    the calling thread, which is released when the thread finishes or calls
+    release_thread(). connection() is a context manager for a short-lived
+    checkout.
+    """
+
+    def __init__(self, connect, size=8, max_idle=60):
+        self._connect = connect
+        self._size = size
+        self._max_idle = max_idle
+
+        self._cond = Condition()
+        self._idle = []
+        self._open = 0
+        self._local = local()
+        self._stats = {"checkouts": 0, "waits": 0, "wait_time": 0.0,
+                       "connects": 0, "reconnects": 0}
+
+    def _new_connection(self):
+        """Create a new connection, freeing its slot if this fails."""
+        try:
+            conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._open -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._stats["connects"] += 1
+        return conn
+
+    def _check(self, conn):
+        """Return the given connection if it is alive, or a replacement."""
+        try:
+            conn.ping()
+            return conn
+        except Exception:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+        with self._cond:
+            self._stats["reconnects"] += 1
+        return self._new_connection()
+
+    def acquire(self):
+        """Check out a connection, waiting for one if the pool is full."""
+        with self._cond:
+            self._stats["checkouts"] += 1
+            if not self._idle and self._open >= self._size:
+                self._stats["waits"] += 1
+                start = time()
+                while not self._idle and self._open >= self._size:
+                    self._cond.wait()
+                self._stats["wait_time"] += time() - start
+
+            if self._idle:
+                conn, last_used = self._idle.pop()
+            else:
+                self._open += 1
+                conn, last_used = None, None
+
+        if conn is None:
+            return self._new_connection()
+        if time() - last_used > self._max_idle:
+            return self._check(conn)
+        return conn
+
+    def release(self, conn):
+        """Return a checked-out connection to the pool."""
+        with self._cond:
+            self._idle.append((conn, time()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """Context manager that checks out a connection for its duration."""
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def get(self):
+        """Return the connection bound to the current thread.
+
+        If the thread doesn't have one yet, a connection is checked out and
+        bound to it. It is returned to the pool when the thread exits.
+        """
+        binding = getattr(self._local, "binding", None)
+        if binding is None:
+            binding = _Binding(self, self.acquire())
+            self._local.binding = binding
+        return binding.conn
+
+    def release_thread(self):
+        """Return the current thread's bound connection to the pool, if any."""
+        binding = getattr(self._local, "binding", None)
+        if binding is not None:
+            del self._local.binding
+            binding.release()
+
+    @property
+    def stats(self):
+        """Return a dict of usage statistics for this pool."""
+        with self._cond:
+            stats = self._stats.copy()
+            stats["open"] = self._open
+            stats["idle"] = len(self._idle)
+        return stats
+
+    def close(self):
+        """Close all idle connections."""
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+            self._cond.notify_all()
+        for conn, _ in idle:
+            conn.close()
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+"""
+This module contains a layer for saving reports that skips no-op edits.
+"""
+
+from hashlib import sha1
+from threading import Lock
+
+from .util import chunked
+
+__all__ = ["Publisher"]
+
+class Publisher:
+    """Saves rendered reports to the wiki, skipping those that haven't changed.
+
+    A digest of the text we last saved to each page is stored in the local
+    published_pages table, along with the page's revision ID after the save.
+    If a new rendering has the same digest and the page hasn't been edited
+    since (according to the replica), neither the page's text is fetched nor
+    a save is attempted.
+    """
+
+    def __init__(self, bot):
+        self._bot = bot
+        self._state = {}
+        self._lock = Lock()
+        self._stats = {"saved": 0, "unchanged": 0, "skipped": 0}
+
+    @staticmethod
+    def _digest(text):
+        """Return the digest of the given page text."""
+        return sha1(text.encode("utf8")).digest()
+
+    def _load(self, titles):
+        """Return a dict mapping titles to stored (digest, revid) pairs."""
+        query = """SELECT pp_title, pp_digest, pp_revid
+            FROM published_pages
+            WHERE pp_site = ? AND pp_title IN ({})"""
+
+        state = {}
+        chunksize = 1000
+        with self._bot.localdb as cursor:
+            for chunk in chunked(titles, chunksize):
+                cursor.execute(query.format(", ".join("?" * len(chunk))),
+                               [self._bot.wikiid] + chunk)
+                state.update((title.decode("utf8"), (digest, revid))
+                             for (title, digest, revid) in cursor.fetchall())
+        return state
+
+    def _store(self, title, digest, revid):
+        """Record the digest and revision of a page we just published."""
+        query = """INSERT INTO published_pages
+            (pp_site, pp_title, pp_digest, pp_revid)
+            VALUES (?, ?, ?, ?)
+            ON DUPLICATE KEY UPDATE pp_digest = ?, pp_revid = ?"""
+
+        with self._bot.localdb as cursor:
+            cursor.execute(query, (self._bot.wikiid, title, digest, revid,
+                                   digest, revid))
+
+    def _record(self, key):
+        """Increment one of the counters in stats."""
+        with self._lock:
+            self._stats[key] += 1
+
+    def prepare(self, titles):
+        """Load the stored state of many pages at once.
+
+        This is optional, but saves a pair of queries per page when a task is
+        about to publish many pages.
+        """
+        titles = [title for title in titles if title not in self._state]
+        if not titles:
+            return
+
+        stored = self._load(titles)
+        latest = self._bot.get_latest_revisions(list(stored))
+        with self._lock:
+            for title in titles:
+                if title in stored:
+                    digest, revid = stored[title]
+                    self._state[title] = (digest, latest.get(title) == revid)
+                else:
+                    self._state[title] = None
+
+    def publish(self, title, text, summary, minor=False):
+        """Save the given text to a page, unless it would be a no-op.
+
+        Return True if the page was saved, or False if it was skipped.
+        """
+        # MediaWiki strips trailing whitespace on save, so compare without it:
+        text = text.rstrip()
+        self.prepare([title])
+        digest = self._digest(text)
+        with self._lock:
+            state = self._state.pop(title)
+
+        if state and state == (digest, True):
+            self._record("skipped")
+            return False
+
+        page = self._bot.get_page(title)
+        if page.text.rstrip() == text:
+            self._record("unchanged")
+            saved = False
+        else:
+            page.text = text
+            page.save(summary, minor=minor)
+            self._record("saved")
+            saved = True
+
+        if page.exists():
+            self._store(title, digest, page.latest_revision_id)
+        return saved
+
+    @property
+    def stats(self):
+        """Return a dict of counts of pages saved and skipped.
+
+        "skipped" pages were skipped by digest without being fetched, and
+        "unchanged" pages were fetched but found to be identical.
+        """
+        with self._lock:
+            return self._stats.copy()
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+"""
+This module contains a resumable, streaming reader for recentchanges.
+"""
+
+from datetime import datetime
+
+__all__ = ["RecentChangesReader"]
+
+class RecentChangesReader:
+    """Reads recentchanges rows from the wiki replica in bounded chunks.
+
+    Rows are paged through in (rc_timestamp, rc_id) order using keyset
+    pagination, so each chunk is a cheap range scan no matter how large the
+    window is. After each chunk has been processed, the position of its last
+    row is saved as a checkpoint under the given *key* in the local
+    rc_checkpoint table. A later reader with the same key resumes from there.
+
+    *conditions* is an SQL fragment that further restricts the rows, like
+    "rc_namespace = 1"; *columns* are the extra columns to return.
+    """
+    TIMESTAMP_FORMAT = "%Y%m%d%H%M%S"
+
+    def __init__(self, bot, key, columns, conditions=None, chunksize=5000):
+        self._bot = bot
+        self._key = key
+        self._columns = columns
+        self._conditions = conditions
+        self._chunksize = chunksize
+
+    def _parse_timestamp(self, timestamp):
+        """Return a datetime for a raw MediaWiki timestamp from the DB."""
+        return datetime.strptime(timestamp.decode("utf8"),
+                                 self.TIMESTAMP_FORMAT)
+
+    def get_checkpoint(self):
+        """Return the saved (timestamp, rc_id) position, or None."""
+        query = """SELECT rcc_timestamp, rcc_id
+            FROM rc_checkpoint
+            WHERE rcc_site = ? AND rcc_key = ?"""
+
+        with self._bot.localdb as cursor:
+            cursor.execute(query, (self._bot.wikiid, self._key))
+            results = cursor.fetchall()
+
+        if not results:
+            return None
+        timestamp, rcid = results[0]
+        return (self._parse_timestamp(timestamp), rcid)
+
+    def set_checkpoint(self, timestamp, rcid):
+        """Save the given (timestamp, rc_id) position."""
+        query = """INSERT INTO rc_checkpoint
+            (rcc_site, rcc_key, rcc_timestamp, rcc_id)
+            VALUES (?, ?, ?, ?)
+            ON DUPLICATE KEY UPDATE rcc_timestamp = ?, rcc_id = ?"""
+
+        stamp = timestamp.strftime(self.TIMESTAMP_FORMAT)
+        with self._bot.localdb as cursor:
+            cursor.execute(query, (self._bot.wikiid, self._key, stamp, rcid,
+                                   stamp, rcid))
+
+    def _fetch(self, cursor, after, end):
+        """Return the next chunk of rows after the given position."""
+        query = """SELECT rc_timestamp, rc_id, {columns}
+            FROM recentchanges
+            WHERE (rc_timestamp > ? OR (rc_timestamp = ? AND rc_id > ?))
+            AND rc_timestamp < ? {conditions}
+            ORDER BY rc_timestamp, rc_id
+            LIMIT ?"""
+
+        conditions = "AND " + self._conditions if self._conditions else ""
+        query = query.format(columns=", ".join(self._columns),
+                             conditions=conditions)
+        stamp, rcid = after
+        cursor.execute(query, (stamp, stamp, rcid, end, self._chunksize))
+        return cursor.fetchall()
+
+    def read(self, start, end):
+        """Yield lists of rows changed between *start* and *end*.
+
+        Each row is (timestamp, rc_id, *columns), with the timestamp as a
+        datetime. Reading begins at the saved checkpoint, if it is later than
+        *start*. The checkpoint is advanced when the caller asks for the next
+        chunk, so a chunk that raises an exception will be read again next
+        time.
+        """
+        checkpoint = self.get_checkpoint()
+        if checkpoint and checkpoint[0] >= start:
+            after = (checkpoint[0].strftime(self.TIMESTAMP_FORMAT),
+                     checkpoint[1])
+        else:
+            # rc_timestamp >= start, written as a strict keyset comparison:
+            after = (start.strftime(self.TIMESTAMP_FORMAT), -1)
+        endstamp = end.strftime(self.TIMESTAMP_FORMAT)
+
+        while True:
+            with self._bot.wikidb as cursor:
+                rows = self._fetch(cursor, after, endstamp)
+            if not rows:
+                break
+
+            chunk = [(self._parse_timestamp(row[0]),) + tuple(row[1:])
+                     for row in rows]
+            yield chunk
+
+            after = (rows[-1][0], rows[-1][1])
+            self.set_checkpoint(chunk[-1][0], chunk[-1][1])
+            if len(rows) < self._chunksize:
+                break
@@ -4,15 +4,20 @@
 This module contains Reports bot's task runner.
 """
 
+from collections import OrderedDict
+from concurrent.futures import (FIRST_COMPLETED, ProcessPoolExecutor,
+                                ThreadPoolExecutor, wait)
+from datetime import datetime
 from importlib.machinery import SourceFileLoader
 import os.path
+from time import time
 
 from .bot import Bot
 from .exceptions import TaskLoaderError
-from .logging import get_logger
+from .logging import get_logger, setup_logging
 from .task import Task
 
-__all__ = ["find_task", "run_task"]
+__all__ = ["find_task", "run_task", "run_tasks", "run_on_wikis"]
 
 _logger = get_logger("runner")
 
@@ -94,6 +99,8 @@ def run_task(task, config, project=None, lang=None):
 
     A Config object must also be provided. If a project or language is not
     given, then we'll use the config's defaults.
+
+    Return True if the task finished successfully and False if it crashed.
     """
     if not project:
         project = config.default_project
@@ -106,7 +113,204 @@ def run_task(task, config, project=None, lang=None):
 
     try:
         task(bot).run()
+        bot.set_last_updated(_task_key(task))
+        for name in task.PROVIDES:
+            bot.set_last_updated("task:" + name)
     except Exception:
         _logger.exception("Task crashed (%s.%s): %s", *log_args)
+        success = False
     else:
         _logger.info("Task finished (%s.%s): %s", *log_args)
+        success = True
+
+    for name, stats in sorted(bot.pool_stats.items()):
+        _logger.debug("Connection pool %s: %s", name, ", ".join(
+            "{}={}".format(key, round(val, 2))
+            for (key, val) in sorted(stats.items())))
+    return success
+
+def _task_key(task):
+    """Return the last_update key recording when a task last finished."""
+    return "task:" + task.__module__
+
+def _build_task_graph(tasks, task_dir):
+    """Return the tasks to run and their prerequisites.
+
+    The result is a 2-tuple of (graph, requires). *graph* is a dict mapping
+    task names to Task classes. It holds the given tasks, along with all of
+    their prerequisites, recursively. *requires* maps each task name to the
+    names of the tasks in the graph that it must wait for.
+
+    A prerequisite that one of the given tasks PROVIDES is satisfied by that
+    task instead of being loaded, and given tasks provided by other given
+    tasks are dropped, so the two never run side by side. Raise
+    TaskLoaderError if a prerequisite can't be found or the dependencies
+    form a cycle.
+    """
+    providers = {}
+    for task in tasks:
+        for name in task.PROVIDES:
+            providers[name] = task.__module__
+
+    graph = OrderedDict()
+    requires = {}
+    pending = []
+    for task in tasks:
+        if task.__module__ in providers:
+            _logger.info("Not running %s separately; provided by %s",
+                         task.__module__, providers[task.__module__])
+        else:
+            pending.append(task)
+
+    while pending:
+        task = pending.pop(0)
+        if task.__module__ in graph:
+            continue
+        graph[task.__module__] = task
+        requires[task.__module__] = tuple(
+            providers.get(name, name) for name in task.REQUIRES)
+        for name in requires[task.__module__]:
+            if name not in graph:
+                pending.append(find_task(name, task_dir))
+
+    resolved = set()
+    while len(resolved) < len(graph):
+        ready = {name for name in graph if name not in resolved
+                 and all(req in resolved for req in requires[name])}
+        if not ready:
+            remaining = [name for name in graph if name not in resolved]
+            _logger.error("Dependency cycle between tasks: %s",
+                          ", ".join(remaining))
+            raise TaskLoaderError(remaining)
+        resolved |= ready
+    return graph, requires
+
+def _is_fresh(task, config, project, lang):
+    """Return whether the given task finished within its freshness window."""
+    if task.FRESHNESS is None:
+        return False
+    bot = Bot(config, project, lang)
+    last = bot.get_last_updated(_task_key(task))
+    bot.release_connections()
+    return last >= datetime.utcnow() - task.FRESHNESS
+
+def run_tasks(tasks, config, project=None, lang=None, task_dir=".",
+              deps=True, workers=4):
+    """Execute the given Task objects, along with their prerequisites.
+
+    Tasks are run once all of their prerequisites have finished, with up to
+    *workers* independent tasks running at once. Prerequisites that weren't
+    explicitly given are skipped if they are still fresh. Tasks whose
+    prerequisites failed are not run. If *deps* is False, prerequisites are
+    ignored and tasks run one at a time in the given order.
+
+    Return a list of (task name, status, duration) tuples, where status is one
+    of "ok", "failed", "fresh", or "blocked".
+    """
+    if not deps:
+        results = []
+        for task in tasks:
+            start = time()
+            success = run_task(task, config, project=project, lang=lang)
+            results.append((task.__module__, "ok" if success else "failed",
+                            time() - start))
+        return results
+
+    project = project or config.default_project
+    lang = lang or config.default_lang
+    requested = {task.__module__ for task in tasks}
+    graph, requires = _build_task_graph(tasks, task_dir)
+    states = OrderedDict()
+    durations = {}
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while len(states) < len(graph):
+            for name, task in graph.items():
+                if name in states or name in running.values():
+                    continue
+                if not all(req in states for req in requires[name]):
+                    continue
+
+                if any(states[req] in ("failed", "blocked")
+                       for req in requires[name]):
+                    _logger.error("Not running %s; prerequisite failed", name)
+                    states[name] = "blocked"
+                elif name not in requested and _is_fresh(
+                        task, config, project, lang):
+                    _logger.info("Skipping %s; still fresh", name)
+                    states[name] = "fresh"
+                else:
+                    future = executor.submit(
+                        run_task, task, config, project=project, lang=lang)
+                    running[future] = name
+                    durations[name] = time()
+
+            if len(states) == len(graph):
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                states[name] = "ok" if future.result() else "failed"
+                durations[name] = time() - durations[name]
+
+    return [(name, state, durations.get(name, 0.0))
+            for (name, state) in states.items()]
+
+def _run_tasks_on_wiki(names, task_dir, config, deps, lang, project):
+    """Run the named tasks on a single wiki, inside a worker process.
+
+    Return a list of (task name, status, duration) tuples.
+    """
+    tasks = [find_task(name, task_dir) for name in names]
+    return run_tasks(tasks, config, project=project, lang=lang,
+                     task_dir=task_dir, deps=deps)
+
+def _log_summary(results):
+    """Log a summary table of task results across wikis."""
+    rows = [("Wiki", "Task", "Status", "Time")]
+    for (lang, project), wikiresults in results:
+        wiki = lang + "." + project
+        if wikiresults is None:
+            rows.append((wiki, "*", "crashed", "-"))
+            continue
+        for name, status, duration in wikiresults:
+            rows.append((wiki, name, status, "%.1fs" % duration))
+
+    widths = [max(len(row[i]) for row in rows) for i in range(4)]
+    _logger.info("Summary:")
+    for row in rows:
+        _logger.info("    " + "  ".join(
+            val.ljust(width) for (val, width) in zip(row, widths)))
+
+def run_on_wikis(names, task_dir, config, wikis, jobs=None, log_dir=None,
+                 quiet=False, deps=True):
+    """Run the named tasks on several wikis in parallel.
+
+    *wikis* is a list of (lang, project) tuples. Each wiki gets its own worker
+    process (up to *jobs* at a time), with its own Bot instance; tasks for a
+    single wiki are scheduled with run_tasks(). A summary table is logged at
+    the end.
+
+    Return True if every task succeeded on every wiki.
+    """
+    _logger.info("Running %s task(s) on %s wikis", len(names), len(wikis))
+    with ProcessPoolExecutor(max_workers=jobs, initializer=setup_logging,
+                             initargs=(log_dir, quiet)) as executor:
+        futures = [(wiki, executor.submit(
+            _run_tasks_on_wiki, names, task_dir, config, deps, *wiki))
+                   for wiki in wikis]
+
+        results = []
+        for wiki, future in futures:
+            try:
+                results.append((wiki, future.result()))
+            except Exception:
+                _logger.exception("Worker crashed (%s.%s)", *wiki)
+                results.append((wiki, None))
+
+    _log_summary(results)
+    return all(wikiresults and all(status in ("ok", "fresh")
+                                   for (_, status, _) in wikiresults)
+               for (_, wikiresults) in results)
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+"""
+This module contains helpers for finding discussions within talk pages.
+"""
+
+import re
+
+__all__ = ["TIMESTAMP_RE", "scan_sections", "parse_sections",
+           "extract_sections"]
+
+TIMESTAMP_RE = re.compile(r"\d\d:\d\d,\s\d\d?\s\w+\s\d{4}\s\(UTC\)")
+
+_HEADING_RE = re.compile(r"^(={1,6})(.+?)(={1,6})[ \t]*$", re.M)
+_UNUSUAL_RE = re.compile(
+    r"<!--|<(?:nowiki|pre|syntaxhighlight|source|math|includeonly|"
+    r"noinclude|onlyinclude)\b", re.I)
+_TEMPLATE_RE = re.compile(r"\{\{|\}\}")
+_NESTING_RE = re.compile(
+    r"\{\{|\}\}|<!--|-->|<(/?)(nowiki|pre|syntaxhighlight|source|math|"
+    r"includeonly|noinclude|onlyinclude)\b[^>]*?(/?)>", re.I)
+
+def _heading_level(match):
+    """Return the level and title of a heading regex match."""
+    opening, title, closing = match.groups()
+    level = min(len(opening), len(closing))
+    title = "=" * (len(opening) - level) + title + "=" * (len(closing) - level)
+    return level, title
+
+def _has_nested(text, positions):
+    """Return whether any of the given positions is nested within markup.
+
+    This tracks templates, comments, and tags like nowiki from the start of
+    the text, so a heading inside a template argument, or inside a comment
+    that opened before it, is caught. *positions* must be sorted.
+    """
+    depth = 0
+    comment = False
+    tags = []
+    tokens = _NESTING_RE.finditer(text)
+    token = next(tokens, None)
+
+    for position in positions:
+        while token and token.start() < position:
+            value = token.group(0)
+            closing, tag, selfclosing = token.groups()
+            if comment:
+                comment = value != "-->"
+            elif tag:
+                tag = tag.lower()
+                if closing:
+                    if tag in tags:
+                        del tags[tags.index(tag):]
+                elif not selfclosing:
+                    tags.append(tag)
+            elif not tags:
+                if value == "<!--":
+                    comment = True
+                elif value == "{{":
+                    depth += 1
+                elif value == "}}":
+                    depth = max(depth - 1, 0)
+            token = next(tokens, None)
+
+        if depth or comment or tags:
+            return True
+    return False
+
+def _find_timestamp(text):
+    """Return the first signature timestamp in raw text outside templates.
+
+    Timestamps inside templates are skipped, since the parser-based path
+    strips templates before searching. Return None if there isn't one.
+    """
+    for match in TIMESTAMP_RE.finditer(text):
+        depth = 0
+        for brace in _TEMPLATE_RE.findall(text, 0, match.start()):
+            depth = depth + 1 if brace == "{{" else max(depth - 1, 0)
+        if not depth:
+            return match.group(0)
+    return None
+
+def scan_sections(text):
+    """Return a list of (name, timestamp) tuples for the given page text.
+
+    This is a fast path that works on raw wikitext: headings are found with a
+    line-based scanner, and signature timestamps with a regex. There is one
+    tuple for each level-2 section that has a timestamp, which is the first
+    one found, as a string.
+
+    Return None if the page has markup that the scanner might misread, like
+    comments, nowiki tags, formatting within headings, or headings nested
+    inside templates. Use parse_sections() for those pages.
+    """
+    headings = []
+    for match in _HEADING_RE.finditer(text):
+        level, title = _heading_level(match)
+        headings.append((match.start(), match.end(), level, title))
+    if not headings:
+        return []
+    if _UNUSUAL_RE.search(text, headings[0][0]):
+        return None
+    if _has_nested(text, [start for (start, _, _, _) in headings]):
+        return None
+
+    sections = []
+    for index, (start, end, level, title) in enumerate(headings):
+        if level != 2:
+            continue
+        if any(char in title for char in "<>[]{}'&"):
+            return None
+
+        stop = len(text)
+        for (nextstart, _, nextlevel, _) in headings[index + 1:]:
+            if nextlevel <= 2:
+                stop = nextstart
+                break
+
+        timestamp = _find_timestamp(title + "\n" + text[end:stop])
+        if timestamp:
+            sections.append((title.strip(), timestamp))
+        elif any(char in text[end:stop] for char in "{<&"):
+            # Stripping markup might reveal a timestamp the scanner missed:
+            return None
+
+    return sections
+
+def parse_sections(text):
+    """Return a list of (name, timestamp) tuples using the full parser.
+
+    This is the same as scan_sections(), but handles any markup. It may raise
+    mwparserfromhell's ParserError.
+    """
+    import mwparserfromhell
+    code = mwparserfromhell.parse(text)
+    sections = []
+
+    for section in code.get_sections(levels=[2]):
+        match = TIMESTAMP_RE.search(section.strip_code())
+        if not match:
+            continue
+        name = str(section.get(0).title.strip_code()).strip()
+        sections.append((name, match.group(0)))
+
+    return sections
+
+def extract_sections(text):
+    """Return a list of (name, timestamp) tuples for the given page text.
+
+    The fast scanner is used when possible, falling back to the full parser
+    for pages with unusual markup.
+    """
+    sections = scan_sections(text)
+    if sections is None:
+        return parse_sections(text)
+    return sections
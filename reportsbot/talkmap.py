@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+
+"""
+This module contains a compact, persistent map of talk pages to subject pages.
+"""
+
+from array import array
+from bisect import bisect_left
+from datetime import datetime
+import mmap
+import os
+import struct
+
+__all__ = ["TalkMap"]
+
+class TalkMap:
+    """Maps talk page IDs to packed subject page info.
+
+    Each value stores the subject page ID shifted left by one bit, with the
+    least significant bit set if the subject page is a redirect. Keys and
+    values are unsigned 32-bit integers held in two parallel arrays sorted by
+    key, so lookups are binary searches.
+
+    A map can be saved to a file and memory-mapped back in later, so large
+    maps don't need to be rebuilt or fully read into memory. Changes made
+    after loading are kept in a small in-memory overlay until the next save,
+    which merges them into a new file.
+
+    The file also records the time the map was last brought up to date.
+    """
+    _MAGIC = b"RBTM"
+    _VERSION = 1
+    _HEADER = struct.Struct("=4sIIQ")  # magic, version, count, timestamp
+    _TYPECODE = "I"
+
+    def __init__(self, keys=None, values=None, timestamp=None):
+        self._keys = keys if keys is not None else array(self._TYPECODE)
+        self._values = values if values is not None else array(self._TYPECODE)
+        self._timestamp = timestamp
+        self._changes = {}
+        self._mmap = None
+
+    @classmethod
+    def build(cls, rows, timestamp=None):
+        """Return a new map from an iterable of (talk_id, value) pairs.
+
+        Building is fastest when the rows are already sorted by talk ID.
+        """
+        keys = array(cls._TYPECODE)
+        values = array(cls._TYPECODE)
+        ordered = True
+        for key, value in rows:
+            if ordered and keys and key <= keys[-1]:
+                ordered = False
+            keys.append(key)
+            values.append(value)
+
+        if not ordered:
+            pairs = sorted(dict(zip(keys, values)).items())
+            keys = array(cls._TYPECODE, (key for key, _ in pairs))
+            values = array(cls._TYPECODE, (value for _, value in pairs))
+
+        return cls(keys, values, timestamp)
+
+    @classmethod
+    def load(cls, filename):
+        """Memory-map and return the map stored in the given file.
+
+        Return None if the file is missing or isn't a valid talkmap.
+        """
+        try:
+            with open(filename, "rb") as fp:
+                data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+
+        size = cls._HEADER.size
+        itemsize = array(cls._TYPECODE).itemsize
+        if len(data) < size:
+            data.close()
+            return None
+
+        magic, version, count, stamp = cls._HEADER.unpack(data[:size])
+        if (magic != cls._MAGIC or version != cls._VERSION or
+                len(data) != size + 2 * count * itemsize):
+            data.close()
+            return None
+
+        view = memoryview(data)
+        keys = view[size:size + count * itemsize].cast(cls._TYPECODE)
+        values = view[size + count * itemsize:].cast(cls._TYPECODE)
+        timestamp = datetime.strptime(str(stamp), "%Y%m%d%H%M%S")
+
+        talkmap = cls(keys, values, timestamp)
+        talkmap._mmap = data
+        return talkmap
+
+    @property
+    def timestamp(self):
+        """Return the time the map was last brought up to date, or None."""
+        return self._timestamp
+
+    def _find(self, key):
+        """Return the index of the given key in the base arrays, or -1."""
+        index = bisect_left(self._keys, key)
+        if index < len(self._keys) and self._keys[index] == key:
+            return index
+        return -1
+
+    def __len__(self):
+        count = len(self._keys)
+        for key, value in self._changes.items():
+            exists = self._find(key) >= 0
+            if value is None and exists:
+                count -= 1
+            elif value is not None and not exists:
+                count += 1
+        return count
+
+    def __contains__(self, key):
+        if key in self._changes:
+            return self._changes[key] is not None
+        return self._find(key) >= 0
+
+    def __getitem__(self, key):
+        if key in self._changes:
+            value = self._changes[key]
+            if value is None:
+                raise KeyError(key)
+            return value
+        index = self._find(key)
+        if index < 0:
+            raise KeyError(key)
+        return self._values[index]
+
+    def __setitem__(self, key, value):
+        self._changes[key] = value
+
+    def get(self, key, default=None):
+        """Return the value for the given key, or the default if missing."""
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def discard(self, key):
+        """Remove the given key from the map, if it is present."""
+        self._changes[key] = None
+
+    def _merge(self):
+        """Return new key and value arrays with pending changes merged in."""
+        keys = array(self._TYPECODE)
+        values = array(self._TYPECODE)
+        pos = 0
+
+        for key in sorted(self._changes):
+            index = bisect_left(self._keys, key)
+            keys.frombytes(self._keys[pos:index].tobytes())
+            values.frombytes(self._values[pos:index].tobytes())
+            pos = index
+            if index < len(self._keys) and self._keys[index] == key:
+                pos += 1
+            value = self._changes[key]
+            if value is not None:
+                keys.append(key)
+                values.append(value)
+
+        keys.frombytes(self._keys[pos:].tobytes())
+        values.frombytes(self._values[pos:].tobytes())
+        return keys, values
+
+    def save(self, filename, timestamp=None):
+        """Write the map to the given file, merging any pending changes.
+
+        The file is replaced atomically, and the map is reloaded from it.
+        """
+        if timestamp is not None:
+            self._timestamp = timestamp
+        keys, values = self._merge()
+        stamp = int(self._timestamp.strftime("%Y%m%d%H%M%S"))
+
+        os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+        tempname = filename + ".tmp"
+        with open(tempname, "wb") as fp:
+            fp.write(self._HEADER.pack(
+                self._MAGIC, self._VERSION, len(keys), stamp))
+            keys.tofile(fp)
+            values.tofile(fp)
+        os.replace(tempname, filename)
+
+        self.close()
+        loaded = self.load(filename)
+        self._keys, self._values = loaded._keys, loaded._values
+        self._mmap = loaded._mmap
+        self._changes = {}
+
+    def close(self):
+        """Release the memory map backing this map, if any."""
+        if self._mmap is not None:
+            self._keys.release()
+            self._values.release()
+            self._keys = array(self._TYPECODE)
+            self._values = array(self._TYPECODE)
+            self._mmap.close()
+            self._mmap = None
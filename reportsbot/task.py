@@ -3,7 +3,19 @@
 from .logging import get_logger
 
 class Task:
-    """Represents a single task to be done by the bot."""
+    """Represents a single task to be done by the bot.
+
+    Tasks may list the names of other tasks that must have run before them in
+    REQUIRES. The runner will run those first, unless they finished within
+    their own FRESHNESS window (a timedelta; None means never fresh).
+
+    PROVIDES lists the names of other tasks whose work this task also does.
+    When it runs, it satisfies their place as prerequisites and counts as a
+    fresh run of them.
+    """
+    REQUIRES = ()
+    PROVIDES = ()
+    FRESHNESS = None
 
     def __init__(self, bot):
         self._bot = bot
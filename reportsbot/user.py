@@ -22,16 +22,8 @@ class User:
     def is_active(self):
         """Return whether or not the user meets a basic threshold of activity.
 
-        Threshold is at least one edit in the past 30 days.
+        Threshold is at least one edit in the past 30 days. Answers come from
+        the bot's shared activity checker, so call self._bot.activity.check()
+        first when checking many users.
         """
-        query = """SELECT COUNT(*)
-            FROM recentchanges_userindex
-            JOIN actor ON rc_actor = actor_id
-            WHERE actor_name = ? AND
-            TIMESTAMP(rc_timestamp) > DATE_SUB(NOW(), INTERVAL 30 DAY)"""
-
-        with self._bot.wikidb as cursor:
-            cursor.execute(query, (self._name,))
-            count = cursor.fetchall()[0][0]
-
-        return count > 0
+        return self._bot.activity.is_active(self._name)
@@ -10,7 +10,7 @@ import pwd
 from .exceptions import ConfigError
 
 __all__ = ["to_sql_format", "to_wiki_format", "split_full_title",
-           "join_full_title", "ensure_ownership"]
+           "join_full_title", "chunked", "ensure_ownership"]
 
 def to_sql_format(title):
     """Convert a page title or username to 'canonical' SQL format.
@@ -65,6 +65,14 @@ def join_full_title(site, ns, title):
     ns_name = site.namespaces[ns].custom_name
     return ns_name + ":" + to_wiki_format(site, title, ignore_ns=True)
 
+def chunked(items, size):
+    """Yield successive slices of at most *size* items from the given list.
+
+    This is mostly used to split long IN lists into several queries.
+    """
+    for start in range(0, len(items), size):
+        yield items[start:start+size]
+
 def ensure_ownership(path):
     """Ensure that we are the owner of the given path.
 
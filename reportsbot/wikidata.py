@@ -2,14 +2,16 @@
 
 import requests
 
+from .util import chunked
+
 __all__ = ["Wikidata"]
 
 class Wikidata:
     """Provides a structured interface for querying Wikidata."""
 
-    def __init__(self, site, db):
+    def __init__(self, site, pool):
         self._site = site
-        self._db = db
+        self._pool = pool
         self._user_agent = None
 
     def _get_user_agent(self):
@@ -23,8 +25,8 @@ class Wikidata:
 
     @property
     def db(self):
-        """Return a connection to Wikidata's SQL database."""
-        return self._db
+        """Return this thread's connection to Wikidata's SQL database."""
+        return self._pool.get()
 
     @staticmethod
     def _parse_sparql_result_binding(bind):
@@ -91,9 +93,8 @@ class Wikidata:
         chunksize = 10000
         pages = []
 
-        with self._db as cursor:
-            for start in range(0, len(items), chunksize):
-                chunk = items[start:start+chunksize]
+        with self.db as cursor:
+            for chunk in chunked(items, chunksize):
                 params = ", ".join("?" * len(chunk))
                 args = [wikiid] + chunk
 
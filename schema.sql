@@ -31,6 +31,126 @@ CREATE TABLE `last_update` (
     PRIMARY KEY (`lu_site`, `lu_key`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
 
+--
+-- Table structure for table `fragment_cache`
+--
+
+DROP TABLE IF EXISTS `fragment_cache`;
+CREATE TABLE `fragment_cache` (
+    `fc_site` VARCHAR(191) NOT NULL,
+    `fc_fragment` VARBINARY(255) NOT NULL,
+    `fc_project_id` INT(8) UNSIGNED DEFAULT NULL,
+    `fc_project_title` VARCHAR(255) DEFAULT NULL,
+    PRIMARY KEY (`fc_site`, `fc_fragment`),
+    KEY (`fc_project_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+--
+-- Table structure for table `page_creation`
+--
+
+DROP TABLE IF EXISTS `page_creation`;
+CREATE TABLE `page_creation` (
+    `pc_site` VARCHAR(191) NOT NULL,
+    `pc_page` INT(8) UNSIGNED NOT NULL,
+    `pc_timestamp` BINARY(14) NOT NULL,
+    PRIMARY KEY (`pc_site`, `pc_page`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+--
+-- Table structure for table `category_cache`
+--
+
+DROP TABLE IF EXISTS `category_cache`;
+CREATE TABLE `category_cache` (
+    `cc_site` VARCHAR(191) NOT NULL,
+    `cc_category` VARBINARY(255) NOT NULL,
+    `cc_depth` INT(11) NOT NULL,
+    `cc_namespaces` VARBINARY(255) NOT NULL,
+    `cc_timestamp` DATETIME NOT NULL,
+    PRIMARY KEY (`cc_site`, `cc_category`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+--
+-- Table structure for table `category_members`
+--
+
+DROP TABLE IF EXISTS `category_members`;
+CREATE TABLE `category_members` (
+    `cm_site` VARCHAR(191) NOT NULL,
+    `cm_category` VARBINARY(255) NOT NULL,
+    `cm_page` INT(8) UNSIGNED NOT NULL,
+    PRIMARY KEY (`cm_site`, `cm_category`, `cm_page`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+--
+-- Table structure for table `metrics_fingerprint`
+--
+
+DROP TABLE IF EXISTS `metrics_fingerprint`;
+CREATE TABLE `metrics_fingerprint` (
+    `mf_site` VARCHAR(191) NOT NULL,
+    `mf_project` VARCHAR(255) NOT NULL,
+    `mf_month` BINARY(6) NOT NULL,
+    `mf_fingerprint` BINARY(20) NOT NULL,
+    `mf_revid` INT(8) UNSIGNED NOT NULL,
+    `mf_extra` MEDIUMTEXT NOT NULL,
+    PRIMARY KEY (`mf_site`, `mf_project`(191), `mf_month`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+--
+-- Table structure for table `rc_checkpoint`
+--
+
+DROP TABLE IF EXISTS `rc_checkpoint`;
+CREATE TABLE `rc_checkpoint` (
+    `rcc_site` VARCHAR(191) NOT NULL,
+    `rcc_key` VARCHAR(191) NOT NULL,
+    `rcc_timestamp` BINARY(14) NOT NULL,
+    `rcc_id` INT(10) UNSIGNED NOT NULL,
+    PRIMARY KEY (`rcc_site`, `rcc_key`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+--
+-- Table structure for table `discussion_pages`
+--
+
+DROP TABLE IF EXISTS `discussion_pages`;
+CREATE TABLE `discussion_pages` (
+    `dp_site` VARCHAR(191) NOT NULL,
+    `dp_title` VARBINARY(512) NOT NULL,
+    `dp_revid` INT(10) UNSIGNED NOT NULL DEFAULT 0,
+    `dp_sections` MEDIUMTEXT NOT NULL,
+    `dp_timestamp` DATETIME NOT NULL,
+    PRIMARY KEY (`dp_site`, `dp_title`),
+    KEY (`dp_site`, `dp_timestamp`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+--
+-- Table structure for table `discussion_lists`
+--
+
+DROP TABLE IF EXISTS `discussion_lists`;
+CREATE TABLE `discussion_lists` (
+    `dl_site` VARCHAR(191) NOT NULL,
+    `dl_project` VARBINARY(512) NOT NULL,
+    `dl_discussions` MEDIUMTEXT NOT NULL,
+    PRIMARY KEY (`dl_site`, `dl_project`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+--
+-- Table structure for table `published_pages`
+--
+
+DROP TABLE IF EXISTS `published_pages`;
+CREATE TABLE `published_pages` (
+    `pp_site` VARCHAR(191) NOT NULL,
+    `pp_title` VARBINARY(512) NOT NULL,
+    `pp_digest` BINARY(20) NOT NULL,
+    `pp_revid` INT(10) UNSIGNED NOT NULL,
+    PRIMARY KEY (`pp_site`, `pp_title`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
 --
 -- Table structure for table `base_page`
 --
@@ -55,6 +175,7 @@ DROP TABLE IF EXISTS `base_project`;
 CREATE TABLE `base_project` (
     `project_id` INT(8) UNSIGNED NOT NULL,
     `project_title` VARCHAR(255) NOT NULL,
+    `project_categories` BINARY(20) NOT NULL,
     PRIMARY KEY (`project_id`),
     KEY (`project_title`(191))
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
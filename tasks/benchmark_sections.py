@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compares the fast section scanner with the full wikitext parser
+"""
+
+from time import perf_counter
+
+from reportsbot.sections import parse_sections, scan_sections
+from reportsbot.task import Task
+from reportsbot.util import join_full_title
+
+__all__ = ["BenchmarkSections"]
+
+class BenchmarkSections(Task):
+    """Benchmarks section extraction on a corpus of recent talk pages.
+
+    The corpus is the most recently edited talk pages on the wiki; its size
+    and the number of timing rounds can be set with "pages" and "rounds" in
+    this task's config. Results are logged, along with any pages where the
+    two paths disagree.
+    """
+    TASK_KEY = "benchmark_sections"
+
+    def _get_corpus_titles(self, limit):
+        """Return the titles of recently edited talk pages."""
+        query = """SELECT DISTINCT rc_namespace, rc_title
+            FROM recentchanges
+            WHERE rc_namespace % 2 = 1 AND rc_namespace != 3
+            AND rc_source IN ('mw.edit', 'mw.new')
+            ORDER BY rc_timestamp DESC
+            LIMIT ?"""
+
+        with self._bot.wikidb as cursor:
+            cursor.execute(query, (limit,))
+            return [join_full_title(self._bot.site, ns, title.decode("utf8"))
+                    for (ns, title) in cursor.fetchall()]
+
+    def _time(self, func, texts, rounds):
+        """Return the best total time of a function over all texts."""
+        best = None
+        for _ in range(rounds):
+            start = perf_counter()
+            for text in texts:
+                func(text)
+            elapsed = perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    def run(self):
+        config = self._bot.config.get_task_config(self.TASK_KEY)
+        limit = config.get("pages", 500)
+        rounds = config.get("rounds", 3)
+
+        titles = self._get_corpus_titles(limit)
+        self._bot.prefetch_pages(titles)
+        texts = {title: self._bot.get_page(title).text for title in titles}
+        size = sum(len(text) for text in texts.values())
+        self._logger.info("Corpus: %s pages, %.1f MB", len(texts),
+                          size / 1024 / 1024)
+
+        scanned = {title: scan_sections(text) for title, text in texts.items()}
+        fallbacks = [title for title, result in scanned.items()
+                     if result is None]
+        mismatches = [title for title, result in scanned.items()
+                      if result is not None and
+                      result != parse_sections(texts[title])]
+
+        fallback_texts = [texts[title] for title in fallbacks]
+        full_time = self._time(parse_sections, texts.values(), rounds)
+        fast_time = self._time(scan_sections, texts.values(), rounds)
+        fallback_time = self._time(parse_sections, fallback_texts, rounds)
+
+        self._logger.info("Full parser: %.3fs", full_time)
+        self._logger.info("Scanner: %.3fs, plus %.3fs for %s fallbacks "
+                          "(%.1fx faster overall)", fast_time, fallback_time,
+                          len(fallbacks),
+                          full_time / max(fast_time + fallback_time, 1e-9))
+        if mismatches:
+            self._logger.warning("Scanner disagrees with parser on %s pages",
+                                 len(mismatches))
+            for title in mismatches:
+                self._logger.debug("    [[%s]]", title)
@@ -6,7 +6,7 @@ Copyright (C) 2015 James Hare, 2016 Ben Kurtovic
 Licensed under MIT License: http://mitlicense.org
 """
 
-from datetime import datetime
+from datetime import datetime, timedelta
 import json
 
 from reportsbot.task import Task
@@ -17,6 +17,7 @@ class LoadProjectConfig(Task):
     """Loads project config from on-wiki and stores it in our database."""
     CONFIG_TITLE = "Project:WikiProject X/wikiproject.json"
     ERROR_TITLE = "Project talk:WikiProject X/wikiproject.json/Errors"
+    FRESHNESS = timedelta(hours=1)
 
     def _report_error(self, message):
         """Report an error to the error page."""
@@ -1,15 +1,19 @@
 # -*- coding: utf-8 -*-
 
 from datetime import datetime
+from hashlib import sha1
+import json
 import re
 
 from reportsbot.task import Task
-from reportsbot.util import to_sql_format, split_full_title, join_full_title
+from reportsbot.util import chunked, split_full_title, join_full_title
 
 __all__ = ["Metrics"]
 
 class Metrics(Task):
     """Updates monthly metrics on the number of articles in a project."""
+    REQUIRES = ("load_project_config", "update_project_index")
+    CHUNKSIZE = 5000
 
     @staticmethod
     def _get_months(start_month):
@@ -35,106 +39,87 @@ class Metrics(Task):
 
         return months
 
+    def _lookup_page_ids(self, titles):
+        """Return a dict mapping page IDs to the given (ns, title) pairs.
+
+        Titles are grouped by namespace so that each query is a single IN
+        list against the (namespace, title) index. Missing pages and
+        redirects are left out.
+        """
+        query = """SELECT page_id, page_namespace, page_title
+        FROM page
+        WHERE page_namespace = ? AND page_title IN ({})
+        AND page_is_redirect = 0"""
+
+        bynamespace = {}
+        for ns, title in titles:
+            bynamespace.setdefault(ns, []).append(title)
+
+        pages = {}
+        with self._bot.wikidb as cursor:
+            for ns, nstitles in bynamespace.items():
+                for chunk in chunked(nstitles, self.CHUNKSIZE):
+                    cursor.execute(query.format(", ".join("?" * len(chunk))),
+                                   [ns] + chunk)
+                    pages.update((pageid, (ns, title.decode("utf8")))
+                                 for (pageid, ns, title) in cursor.fetchall())
+        return pages
+
     def _fetch_articles_by_index(self, project):
-        """Return a list of articles in the project, using the SQL index."""
+        """Return a dict of articles in the project, using the SQL index."""
         self._logger.debug("Using project index for scope")
         pages = project.get_members(namespaces=0, redirect=False)
-        return [(page.ns, page.title) for page in pages]
+        return {page.id: (page.ns, page.title) for page in pages}
 
     def _fetch_articles_by_wikidata(self, query):
-        """Return a set of articles in the project, using a Wikidata query."""
+        """Return a dict of articles in the project, using a Wikidata query."""
         self._logger.debug("Using Wikidata for scope")
 
         try:
             items = self._bot.wikidata.query(query)
         except ValueError as exc:
             self._logger.warn("Invalid results for query: %s: %s", query, exc)
-            return set()
+            return {}
 
         titles = self._bot.wikidata.get_linked_pages(self._bot.wikiid, items)
-        return {split_full_title(self._bot.site, title) for title in titles}
+        return self._lookup_page_ids(
+            {split_full_title(self._bot.site, title) for title in titles})
 
-    def _fetch_articles_by_categories(self, cats):
-        """Return a set of articles in the project, using a list of cats."""
+    def _fetch_articles_by_categories(self, cats, depth=None):
+        """Return a dict of articles in the project, using a list of cats."""
         self._logger.debug("Using categories for scope")
-
-        query = """SELECT page_namespace, page_title
-        FROM categorylinks
-        JOIN page ON page_id = cl_from
-        WHERE cl_to IN ({})
-        AND page_namespace IN (0, 14) AND page_is_redirect = 0"""
-
-        pages = set()
-        cats = [to_sql_format(cat) for cat in cats]
-        processed = []
-
-        with self._bot.wikidb as cursor:
-            while cats:
-                processed.extend(cats)
-                cursor.execute(query.format(", ".join("?" * len(cats))), cats)
-                results = [(ns, title.decode("utf8"))
-                           for (ns, title) in cursor.fetchall()]
-
-                pages |= {(ns, title) for (ns, title) in results if ns == 0}
-                cats = [title for (ns, title) in results
-                        if ns == 14 and title not in processed]
-
-        return pages
+        return self._bot.categories.get_members(cats, max_depth=depth)
 
     def _fetch_articles(self, project):
-        """Return a list of articles in the project."""
+        """Return a dict mapping page IDs to articles in the project.
+
+        Each article is a (ns, title) pair.
+        """
         config = project.config["metrics"]
         cats = config.get("categories")
+        depth = config.get("category_depth")
         wdq = config.get("wikidata_query")
 
         if not cats and not wdq:
             return self._fetch_articles_by_index(project)
 
-        articles = set()
+        articles = {}
         if cats:
-            articles |= self._fetch_articles_by_categories(cats)
+            articles.update(self._fetch_articles_by_categories(cats, depth))
         if wdq:
-            articles |= self._fetch_articles_by_wikidata(wdq)
-        return list(articles)
-
-    def _lookup_pages(self, pages):
-        """Given some pages, return a list of them and their creation dates."""
-        query = """SELECT page_namespace, page_title, MIN(rev_timestamp)
-        FROM revision
-        JOIN page ON rev_page = page_id
-        WHERE ({})
-        GROUP BY page_id"""
-        clause = "(page_namespace = ? AND page_title = ?)"
-
-        chunksize = 10000
-        results = []
-
-        with self._bot.wikidb as cursor:
-            for start in range(0, len(pages), chunksize):
-                if start != 0:
-                    self._logger.debug("Done: %s/%s", start, len(pages))
-
-                chunk = pages[start:start+chunksize]
-                params = " OR ".join([clause] * len(chunk))
-                args = [arg for page in chunk for arg in page]
-
-                cursor.execute(query.format(params), args)
-                chunkdata = cursor.fetchall()
-                results.extend([(ns, title.decode("utf8"), ts.decode("utf8"))
-                                for (ns, title, ts) in chunkdata])
-
-        return results
+            articles.update(self._fetch_articles_by_wikidata(wdq))
+        return articles
 
     def _bucket_articles(self, articles, buckets):
         """Place each article inside a month bucket."""
         self._logger.debug("Bucketing articles")
 
-        pages = self._lookup_pages(articles)
-        for (ns, title, timestamp) in pages:
-            creation = datetime.strptime(timestamp, "%Y%m%d%H%M%S")
-            month = datetime(creation.year, creation.month, 1)
-            if month in buckets:
-                buckets[month].append((ns, title))
+        keys = {month.strftime("%Y%m"): month for month in buckets}
+        timestamps = self._bot.creation_dates.get(list(articles))
+        for pageid, timestamp in timestamps.items():
+            month = keys.get(timestamp[:6])
+            if month:
+                buckets[month].append(articles[pageid])
 
     def _check_for_redlinks(self, titles):
         """Given a list of article titles, return those which don't exist."""
@@ -142,21 +127,7 @@ class Metrics(Task):
             return []
 
         self._logger.debug("Checking %s possible redlinks", len(titles))
-
-        query = "SELECT page_namespace, page_title FROM page WHERE ({})"
-        clause = "(page_namespace = ? AND page_title = ?)"
-
-        with self._bot.wikidb as cursor:
-            params = " OR ".join([clause] * len(titles))
-            args = [arg for title in titles
-                    for arg in split_full_title(self._bot.site, title)]
-
-            cursor.execute(query.format(params), args)
-            results = cursor.fetchall()
-
-        valid = {join_full_title(self._bot.site, ns, title.decode("utf8"))
-                 for (ns, title) in results}
-        return list(set(titles) - valid)
+        return list(self._bot.existence.missing(titles))
 
     def _list_item_for_title(self, title):
         """Return a list item string for the given title."""
@@ -168,7 +139,12 @@ class Metrics(Task):
         return "# [[{}]]".format(title)
 
     def _build_page_list(self, articles, oldlist):
-        """Return a metrics subpage's new article list."""
+        """Return a metrics subpage's new article list.
+
+        The result is a 3-tuple of (pagelist, count, extra). *extra* is a list
+        of the titles of entries that users added, which are only kept while
+        their pages exist.
+        """
         titles = [join_full_title(self._bot.site, ns, title)
                   for (ns, title) in articles]
         possible_redlinks = []
@@ -187,8 +163,10 @@ class Metrics(Task):
                 possible_redlinks.append(title)
             entries[title] = line
 
-        for title in self._check_for_redlinks(possible_redlinks):
+        redlinks = set(self._check_for_redlinks(possible_redlinks))
+        for title in redlinks:
             del entries[title]
+        extra = sorted(set(possible_redlinks) - redlinks)
 
         # Join list of entries' values, sorted by the corresponding keys:
         pagelist = "\n".join(val for (key, val) in
@@ -196,10 +174,14 @@ class Metrics(Task):
 
         # Exclude commented-out lines in the count:
         count = sum(1 for val in entries.values() if val.startswith("#"))
-        return pagelist, count
+        return pagelist, count, extra
 
     def _build_page_text(self, month, articles, oldtext, template):
-        """Return a metrics subpage's new content."""
+        """Return a metrics subpage's new content.
+
+        The result is a 2-tuple of (text, extra), where *extra* is as in
+        _build_page_list().
+        """
         self._logger.debug("Updating month: %s (%s articles)",
                            month.strftime("%B %Y"), len(articles))
 
@@ -208,7 +190,7 @@ class Metrics(Task):
             comment.format("start", key) + body + comment.format("end", key))
 
         oldlist = re.search(wrap("list", r"(.*?)"), oldtext, re.S)
-        pagelist, count = self._build_page_list(
+        pagelist, count, extra = self._build_page_list(
             articles, oldlist.group(1).strip() if oldlist else "")
 
         replacements = {
@@ -230,7 +212,7 @@ class Metrics(Task):
             for key, val in replacements.items():
                 newtext = newtext.replace("{{{" + key + "}}}", val)
 
-        return newtext
+        return newtext, extra
 
     def _create_metrics_page(self, project, title):
         """Create a missing base metrics page for the given project."""
@@ -283,15 +265,94 @@ The bot keeps this list alphabetized and removes deleted pages.
         page.save("Creating template", minor=False)
         return text
 
+    @staticmethod
+    def _get_fingerprint(articles):
+        """Return a digest identifying the given set of articles."""
+        digest = sha1()
+        for ns, title in sorted(articles):
+            digest.update("{}:{}\n".format(ns, title).encode("utf8"))
+        return digest.digest()
+
+    def _load_fingerprints(self, project):
+        """Return saved month page state for the given project.
+
+        The result is a dict mapping YYYYMM month strings to (fingerprint,
+        revid, extra) tuples, where revid is the page's revision after our last
+        save and extra is the list of user-added titles on the page.
+        """
+        query = """SELECT mf_month, mf_fingerprint, mf_revid, mf_extra
+            FROM metrics_fingerprint
+            WHERE mf_site = ? AND mf_project = ?"""
+
+        with self._bot.localdb as cursor:
+            cursor.execute(query, (self._bot.wikiid, project.name))
+            return {month.decode("utf8"): (fingerprint, revid,
+                                           json.loads(extra))
+                    for (month, fingerprint, revid, extra)
+                    in cursor.fetchall()}
+
+    def _save_fingerprint(self, project, month, fingerprint, revid, extra):
+        """Record the state of a month page we just saved."""
+        query = """INSERT INTO metrics_fingerprint
+            (mf_site, mf_project, mf_month, mf_fingerprint, mf_revid,
+             mf_extra)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON DUPLICATE KEY UPDATE mf_fingerprint = ?, mf_revid = ?,
+            mf_extra = ?"""
+
+        extra = json.dumps(extra)
+        with self._bot.localdb as cursor:
+            cursor.execute(query, (self._bot.wikiid, project.name, month,
+                                   fingerprint, revid, extra, fingerprint,
+                                   revid, extra))
+
+    def _get_changed_months(self, project, titles, fingerprints):
+        """Return the months whose pages need to be updated.
+
+        *titles* maps months to page titles, and *fingerprints* maps months to
+        the digests of their current article sets. A month can be skipped if
+        its articles are the same as when we last saved it, nobody has edited
+        the page since, and none of the entries that users added to it have
+        been deleted.
+        """
+        saved = self._load_fingerprints(project)
+        unchanged = [month for month in titles
+                     if saved.get(month.strftime("%Y%m"), (None,))[0] ==
+                     fingerprints[month]]
+        latest = self._bot.get_latest_revisions(
+            [titles[month] for month in unchanged])
+
+        skip = {month for month in unchanged if latest.get(titles[month]) ==
+                saved[month.strftime("%Y%m")][1]}
+
+        extra = {month: saved[month.strftime("%Y%m")][2] for month in skip}
+        redlinks = self._bot.existence.missing(
+            [title for names in extra.values() for title in names])
+        skip = {month for month in skip if not redlinks & set(extra[month])}
+        if skip:
+            self._logger.debug("Skipping %s unchanged months", len(skip))
+        return [month for month in titles if month not in skip]
+
     def _save_metrics(self, project, months, buckets):
         """Save compiled metrics for the given project."""
         config = project.config["metrics"]
         base_title = config.get("page", project.name + "/Metrics")
 
+        titles = {month: base_title + "/" + month.strftime("%B %Y")
+                  for month in months}
+        fingerprints = {month: self._get_fingerprint(buckets[month])
+                        for month in months}
+        changed = self._get_changed_months(project, titles, fingerprints)
+        if not changed:
+            return
+
+        tmpl_title = base_title + "/Template"
+        self._bot.prefetch_pages([base_title, tmpl_title] +
+                                 [titles[month] for month in changed])
+
         if not self._bot.get_page(base_title).text:
             self._create_metrics_page(project, base_title)
 
-        tmpl_title = base_title + "/Template"
         template = self._bot.get_page(tmpl_title).text
         if not template:
             template = self._create_template(project, tmpl_title)
@@ -299,12 +360,15 @@ The bot keeps this list alphabetized and removes deleted pages.
         tmpl_comment = "<!-- Created from: [[{}]] -->\n".format(tmpl_title)
         template = tmpl_comment + template
 
-        for month in months:
-            monthname = month.strftime("%B %Y")
-            page = self._bot.get_page(base_title + "/" + monthname)
-            page.text = self._build_page_text(month, buckets[month], page.text,
-                                              template)
+        for month in changed:
+            page = self._bot.get_page(titles[month])
+            page.text, extra = self._build_page_text(
+                month, buckets[month], page.text, template)
             page.save("Updating monthly metrics", minor=False)
+            self._save_fingerprint(project, month.strftime("%Y%m"),
+                                   fingerprints[month],
+                                   page.latest_revision_id, extra)
+        self._bot.clear_page_cache()
 
     def _update_metrics(self, project):
         """Update metrics for the given project."""
@@ -334,9 +398,5 @@ The bot keeps this list alphabetized and removes deleted pages.
         self._save_metrics(project, months, buckets)
 
     def run(self):
-        for project in self._bot.get_configured_projects():
-            if "metrics" not in project.config:
-                continue
-            if not project.config["metrics"].get("enabled"):
-                continue
+        for project in self._bot.get_configured_projects("metrics"):
             self._update_metrics(project)
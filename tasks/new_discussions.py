@@ -6,108 +6,600 @@ Copyright (C) 2015 James Hare, 2016 Ben Kurtovic
 Licensed under MIT License: http://mitlicense.org
 """
 
+from bisect import bisect_left, bisect_right
 from collections import namedtuple
-from datetime import datetime
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta
+from html import unescape
+import json
+import multiprocessing
 import re
 
+from reportsbot.recentchanges import RecentChangesReader
+from reportsbot.sections import TIMESTAMP_RE, parse_sections, scan_sections
 from reportsbot.task import Task
-from reportsbot.util import join_full_title
+from reportsbot.util import chunked, join_full_title, split_full_title
 
 import mwparserfromhell
+import pywikibot
 from pywikibot.data.api import Request
 
 __all__ = ["NewDiscussions"]
 
 _Section = namedtuple("_Section", ["name", "timestamp"])
+_Heading = namedtuple("_Heading", ["name", "timestamp", "line", "stamp_line"])
+_Outline = namedtuple("_Outline", ["length", "headings"])
+
+_HEADING_RE = re.compile(r"^==([^=].*?)==\s*$")
+_DIFF_CELL_RE = re.compile(
+    r'<td [^>]*class="diff-(addedline|deletedline|context|lineno)[^"]*"[^>]*>'
+    r"(.*?)</td>", re.S)
+_MARKUP_RE = re.compile(
+    r"<!--|-->|</?(?:nowiki|pre|syntaxhighlight|source|math|includeonly|"
+    r"noinclude|onlyinclude)\b", re.I)
 _Discussion = namedtuple("_Discussion", ["title", "name", "timestamp"])
 
 class NewDiscussions(Task):
     """Updates a list of new discussions within a WikiProject's scope."""
+    REQUIRES = ("load_project_config", "update_project_index")
     DISCUSSION_TEMPLATE = "WPX new discussion"
     DISCUSSIONS_PER_PAGE = 15
     DISCUSSIONS_BEFORE_FOLD = 4
+    UPDATE_KEY = "new_discussions"
+    CHANGES_PER_CHUNK = 2000
+    STATE_LIFETIME = timedelta(days=30)
+    CHECK_KEY = "new_discussions_check"
+    CHECK_INTERVAL = timedelta(days=7)
+
+    def __init__(self, bot):
+        super().__init__(bot)
+        config = bot.config.get_task_config(self.UPDATE_KEY)
+        self._use_diffs = config.get("use_diffs", True)
+        self._fetch_workers = config.get("fetch_workers", 4)
+        self._parse_workers = config.get("parse_workers", 2)
+        self._parsers = None
 
     @staticmethod
     def _parse_timestamp(text):
         """Return a datetime for the given timestamp string, or ValueError."""
         return datetime.strptime(str(text), "%H:%M, %d %B %Y (UTC)")
 
-    def _extract_sections(self, text):
-        """Return a list of section tuples for the given page."""
-        code = mwparserfromhell.parse(text)
-        sections = set()
+    @staticmethod
+    def _heading_name(title):
+        """Return the section name for the raw title of a heading."""
+        if any(char in title for char in "<>[]{}'&"):
+            return str(mwparserfromhell.parse(title).strip_code()).strip()
+        return title.strip()
 
-        for section in code.get_sections(levels=[2]):
-            clean = section.strip_code()
-            match = re.search(r"\d\d:\d\d,\s\d\d?\s\w+\s\d{4}\s\(UTC\)", clean)
-            if not match:
-                continue
-            try:
-                timestamp = self._parse_timestamp(match.group(0))
-            except ValueError:
-                continue
+    @staticmethod
+    def _find_timestamp(line):
+        """Return the first signature timestamp in a line of text, or None.
 
-            name = str(section.get(0).title.strip_code()).strip()
-            sections.add(_Section(name, timestamp))
+        Markup is stripped first, as the parser does when reading sections.
+        """
+        if any(char in line for char in "<>[]{}'&"):
+            line = str(mwparserfromhell.parse(line).strip_code())
+        match = TIMESTAMP_RE.search(line)
+        return match.group(0) if match else None
+
+    def _make_outline(self, text, pairs):
+        """Return an outline of a page, given its text and section pairs.
+
+        The outline has a _Heading for every level-2 heading, including those
+        of sections without a timestamp, with the line numbers of the heading
+        and of the section's first timestamp. If the headings we find don't
+        line up with *pairs*, or a section's timestamp isn't on any of its
+        lines, the outline is kept without line numbers, and the page is
+        reloaded in full on its next change.
+        """
+        lines = text.split("\n")
+        found = []
+        for num, line in enumerate(lines, 1):
+            match = _HEADING_RE.match(line)
+            if match:
+                found.append((self._heading_name(match.group(1)), num))
+
+        headings = []
+        remaining = list(pairs)
+        for index, (name, line) in enumerate(found):
+            timestamp = stamp_line = None
+            end = (found[index + 1][1] if index + 1 < len(found)
+                   else len(lines) + 1)
+            if remaining and remaining[0][0] == name:
+                stamp = remaining[0][1]
+                stamp_line = next((num for num in range(line, end)
+                                   if stamp in lines[num - 1]), None)
+                if stamp_line:
+                    del remaining[0]
+                    try:
+                        timestamp = self._parse_timestamp(stamp)
+                    except ValueError:
+                        stamp_line = None
+            headings.append(_Heading(name, timestamp, line, stamp_line))
+
+        if remaining:
+            headings = []
+            for name, stamp in pairs:
+                try:
+                    timestamp = self._parse_timestamp(stamp)
+                except ValueError:
+                    continue
+                headings.append(_Heading(name, timestamp, None, None))
+            return _Outline(None, headings)
+        return _Outline(len(lines), headings)
 
-        return sections
+    @staticmethod
+    def _get_sections(outline):
+        """Return the set of timestamped section tuples in an outline."""
+        return {_Section(heading.name, heading.timestamp)
+                for heading in outline.headings if heading.timestamp}
 
     def _load_pages(self, titles):
-        """Load a chunk of pages from the API."""
+        """Load a chunk of pages from the API.
+
+        Return a list of (title, revid, text) tuples.
+        """
         def _get_rev(page):
             try:
-                return page["revisions"][0]["slots"]["main"]["content"]
+                rev = page["revisions"][0]
+                return rev["revid"], rev["slots"]["main"]["content"]
             except (KeyError, IndexError):
-                return ""
+                return 0, ""
 
         req = Request(self._bot.site, parameters={
-            "action": "query", "prop": "revisions", "rvprop": "content",
+            "action": "query", "prop": "revisions", "rvprop": "ids|content",
             "rvslots": "main", "formatversion": "2", "titles": "|".join(titles)
         })
 
         data = req.submit()
-        return [(page["title"], _get_rev(page))
+        return [(page["title"],) + _get_rev(page)
                 for page in data["query"]["pages"]]
 
+    def _load_diff(self, fromrev, torev):
+        """Return the HTML diff between two revisions, or None on error."""
+        req = Request(self._bot.site, parameters={
+            "action": "compare", "fromrev": fromrev, "torev": torev,
+            "formatversion": "2"
+        })
+
+        try:
+            data = req.submit()
+            return data["compare"]["body"]
+        except (pywikibot.exceptions.Error, KeyError):
+            return None
+
+    @staticmethod
+    def _get_diff_lines(body):
+        """Return a list of (kind, value) tuples for the lines of a diff.
+
+        The kind is "+" for an added line and "-" for a removed one, with the
+        line's text as the value; " " for a line of context, with its text;
+        and "@" for the start of a hunk, with an (old, new) tuple of line
+        numbers. Raise ValueError if the line numbers can't be read.
+        """
+        lines = []
+        for row in body.split("<tr")[1:]:
+            cells = [(kind, unescape(re.sub(r"<[^>]*>", "", cell)))
+                     for (kind, cell) in _DIFF_CELL_RE.findall(row)]
+            kinds = [kind for (kind, _) in cells]
+            if "lineno" in kinds:
+                old, new = [int(re.sub(r"\D", "", text))
+                            for (kind, text) in cells if kind == "lineno"]
+                lines.append(("@", (old, new)))
+            elif "context" in kinds:
+                lines.append((" ", cells[0][1]))
+            else:
+                lines.extend(("-" if kind == "deletedline" else "+", text)
+                             for (kind, text) in cells)
+        return lines
+
+    def _apply_diff(self, outline, lines):
+        """Return the new outline of a page, given its old one and a diff.
+
+        Changed lines are placed within the stored outline by line number, so
+        replies, new sections, and archived sections are understood without
+        loading the page, and only added lines are parsed. Return None if the
+        diff might move a section's first timestamp in a way we can't see from
+        the diff alone, uses markup that could span lines, or doesn't line up
+        with the outline.
+        """
+        if outline.length is None:
+            return None
+
+        old = {heading.line: heading for heading in outline.headings}
+        oldlines = sorted(old)
+        inserts = []
+        deletes = []
+        pos = 0
+
+        for kind, value in lines:
+            if kind == "@":
+                pos, new = value
+                if new != pos + len(inserts) - len(deletes):
+                    return None
+                continue
+            heading = _HEADING_RE.match(value)
+            if kind == " ":
+                known = old.get(pos)
+                if bool(heading) != bool(known) or (
+                        known and known.name != self._heading_name(
+                            heading.group(1))):
+                    return None
+                pos += 1
+                continue
+            if not heading and (value.count("{{") != value.count("}}") or
+                                _MARKUP_RE.search(value)):
+                return None
+            if kind == "-":
+                deletes.append((pos, value))
+                pos += 1
+            else:
+                inserts.append((pos, value))
+
+        if not inserts and not deletes:
+            return outline
+
+        inspositions = [line for (line, _) in inserts]
+        delpositions = [line for (line, _) in deletes]
+        deleted = set(delpositions)
+
+        def newline(index):
+            line = inserts[index][0]
+            return line + index - bisect_left(delpositions, line)
+
+        def owner(line):
+            index = bisect_right(oldlines, line)
+            return old[oldlines[index - 1]] if index else None
+
+        removed = set()
+        for line, text in deletes:
+            heading = _HEADING_RE.match(text)
+            if heading:
+                if line not in old or old[line].name != self._heading_name(
+                        heading.group(1)):
+                    return None
+                removed.add(line)
+
+        marks = [((line, 1), heading) for (line, heading) in old.items()]
+        for index, (line, text) in enumerate(inserts):
+            heading = _HEADING_RE.match(text)
+            if heading:
+                added = {"name": self._heading_name(heading.group(1)),
+                         "pos": line, "line": newline(index),
+                         "lead": [(newline(index), text)], "tail": []}
+                marks.append(((line, 0, index), added))
+        marks.sort(key=lambda mark: mark[0])
+        keys = [key for (key, _) in marks]
+
+        firsts = {}
+        for index, (line, text) in enumerate(inserts):
+            if _HEADING_RE.match(text):
+                continue
+            at = bisect_left(keys, (line, 0, index))
+            section = marks[at - 1][1] if at else None
+            if isinstance(section, dict):
+                part = "lead" if line == section["pos"] else "tail"
+                section[part].append((newline(index), text))
+            elif not section or section.line in firsts or (
+                    section.timestamp and section.stamp_line is not None and
+                    line > section.stamp_line):
+                continue
+            else:
+                stamp = self._find_timestamp(text)
+                if not stamp:
+                    continue
+                if section.line in removed or (
+                        section.timestamp and section.stamp_line is None):
+                    return None
+                try:
+                    # The section's new first timestamp:
+                    firsts[section.line] = (self._parse_timestamp(stamp),
+                                            newline(index))
+                except ValueError:
+                    return None
+
+        for line, text in deletes:
+            if line in removed:
+                continue
+            section = owner(line)
+            if not section or section.line in removed:
+                continue
+            if section.timestamp and (
+                    section.stamp_line is None or line <= section.stamp_line
+            ) and (line == section.stamp_line or self._find_timestamp(text)):
+                return None
+
+        addedmarks = [mark for (_, mark) in marks if isinstance(mark, dict)]
+        for index, section in enumerate(addedmarks):
+            timestamp = stamp_line = None
+            for line, text in section["lead"]:
+                stamp = self._find_timestamp(text)
+                if stamp:
+                    try:
+                        timestamp = self._parse_timestamp(stamp)
+                    except ValueError:
+                        return None
+                    stamp_line = line
+                    break
+            section["heading"] = _Heading(
+                section["name"], timestamp, section["line"], stamp_line)
+
+            pos = section["pos"]
+            last = (index + 1 == len(addedmarks) or
+                    addedmarks[index + 1]["pos"] != pos)
+            if last and pos <= outline.length and (
+                    pos not in old or pos in removed):
+                # Old text after the new heading now belongs to its section:
+                split = owner(pos)
+                if not split or split.timestamp:
+                    if not timestamp:
+                        return None
+                    if split and split.line not in removed and (
+                            split.stamp_line is None or
+                            split.stamp_line >= pos):
+                        return None
+            if not timestamp and any(self._find_timestamp(text)
+                                     for (_, text) in section["tail"]):
+                return None
+
+        for line in removed:
+            heading = old[line]
+            index = oldlines.index(line)
+            end = (oldlines[index + 1] if index + 1 < len(oldlines)
+                   else outline.length + 1)
+            if not heading.timestamp or all(
+                    num in deleted for num in range(line + 1, end)):
+                continue
+            # What's left of the section joins the one before it:
+            before = None
+            for _, mark in reversed(marks[:keys.index((line, 1))]):
+                if isinstance(mark, dict):
+                    before = mark["heading"]
+                    break
+                if mark.line not in removed:
+                    before = mark
+                    break
+            if before and not before.timestamp:
+                return None
+
+        def shift(line):
+            return (line + bisect_right(inspositions, line) -
+                    bisect_left(delpositions, line))
+
+        headings = []
+        for heading in outline.headings:
+            if heading.line in removed:
+                continue
+            if heading.line in firsts:
+                timestamp, stamp_line = firsts[heading.line]
+            else:
+                timestamp = heading.timestamp
+                stamp_line = heading.stamp_line and shift(heading.stamp_line)
+            headings.append(heading._replace(
+                timestamp=timestamp, line=shift(heading.line),
+                stamp_line=stamp_line))
+        headings += [section["heading"] for section in addedmarks]
+        headings.sort(key=lambda heading: heading.line)
+        return _Outline(outline.length + len(inserts) - len(deletes),
+                        headings)
+
+    def _diff_sections(self, title, outline, fromrev, torev):
+        """Return a page's new outline by diffing from the last seen revision.
+
+        Return None if the page needs to be reloaded in full instead.
+        """
+        body = self._load_diff(fromrev, torev)
+        if body is None:
+            return None
+        try:
+            return self._apply_diff(outline, self._get_diff_lines(body))
+        except ValueError:
+            self._logger.warning("Couldn't read diff of [[%s]]", title)
+            return None
+        except mwparserfromhell.parser.ParserError:
+            self._logger.exception("Failed to parse diff of [[%s]]", title)
+            return None
+
+    def _load_state(self, titles):
+        """Return the stored (revid, outline) of the given pages."""
+        query = """SELECT dp_title, dp_revid, dp_sections
+            FROM discussion_pages
+            WHERE dp_site = ? AND dp_title IN ({})"""
+
+        state = {}
+        chunksize = 1000
+        with self._bot.localdb as cursor:
+            for chunk in chunked(titles, chunksize):
+                cursor.execute(query.format(", ".join("?" * len(chunk))),
+                               [self._bot.wikiid] + chunk)
+                for title, revid, data in cursor.fetchall():
+                    state[title.decode("utf8")] = (
+                        revid, self._decode_outline(data))
+        return state
+
+    @staticmethod
+    def _encode_outline(outline):
+        """Return a JSON string for storing the given page outline."""
+        return json.dumps({
+            "length": outline.length,
+            "headings": [
+                (heading.name,
+                 heading.timestamp and heading.timestamp.strftime(
+                     "%Y%m%d%H%M%S"),
+                 heading.line, heading.stamp_line)
+                for heading in outline.headings]
+        })
+
+    @staticmethod
+    def _decode_outline(data):
+        """Return a page outline from a stored JSON string."""
+        data = json.loads(data)
+        return _Outline(data["length"], [
+            _Heading(name, stamp and datetime.strptime(stamp, "%Y%m%d%H%M%S"),
+                     line, stamp_line)
+            for (name, stamp, line, stamp_line) in data["headings"]])
+
+    def _save_sections(self, outlines, revids, timestamps):
+        """Store the outlines of some updated pages in the local database.
+
+        *outlines* maps page titles to page outlines, *revids* maps them to
+        the revision the outlines were taken from, and *timestamps* maps them
+        to the time of their latest change.
+        """
+        query = """INSERT INTO discussion_pages
+            (dp_site, dp_title, dp_revid, dp_sections, dp_timestamp)
+            VALUES (?, ?, ?, ?, ?)
+            ON DUPLICATE KEY UPDATE dp_revid = VALUES(dp_revid),
+            dp_sections = VALUES(dp_sections),
+            dp_timestamp = VALUES(dp_timestamp)"""
+
+        rows = [(self._bot.wikiid, title, revids[title],
+                 self._encode_outline(outline), timestamps[title])
+                for (title, outline) in outlines.items()]
+
+        with self._bot.localdb as cursor:
+            cursor.executemany(query, rows)
+
+    def _load_sections(self, start):
+        """Return stored sections for pages changed since the given time."""
+        query = """SELECT dp_title, dp_sections
+            FROM discussion_pages
+            WHERE dp_site = ? AND dp_timestamp >= ?"""
+
+        with self._bot.localdb as cursor:
+            cursor.execute(query, (self._bot.wikiid, start))
+            results = cursor.fetchall()
+
+        return {title.decode("utf8"):
+                self._get_sections(self._decode_outline(data))
+                for (title, data) in results}
+
+    def _prune_state(self, before):
+        """Forget stored pages that haven't changed since the given time."""
+        query = """DELETE FROM discussion_pages
+            WHERE dp_site = ? AND dp_timestamp < ?"""
+
+        with self._bot.localdb as cursor:
+            cursor.execute(query, (self._bot.wikiid, before))
+
+    def _process_changes(self, changes):
+        """Extract and store the outlines of pages in a chunk of changes.
+
+        If we have seen a page before, only the diff from the last revision we
+        saw is fetched and parsed. Otherwise, or if the diff can't be used,
+        the page's full text is loaded.
+
+        API requests are made from a small thread pool; Pywikibot's shared
+        throttle backs all of them off together when the servers report
+        maxlag. Pages the fast scanner can't handle are parsed in a process
+        pool, while other requests are still running.
+        """
+        timestamps = {}
+        latest = {}
+        for timestamp, _, ns, title, revid in changes:
+            fulltitle = join_full_title(self._bot.site, ns,
+                                        title.decode("utf8"))
+            timestamps[fulltitle] = timestamp
+            if revid:
+                latest[fulltitle] = revid
+
+        titles = list(timestamps)
+        state = self._load_state(titles) if self._use_diffs else {}
+        outlines = {}
+        revids = {}
+        reload = []
+
+        diffs = []
+
+        for title in titles:
+            oldrev, outline = state.get(title, (0, None))
+            newrev = latest.get(title)
+            if oldrev and newrev:
+                if newrev <= oldrev:
+                    outlines[title], revids[title] = outline, oldrev
+                else:
+                    diffs.append((title, outline, oldrev, newrev))
+            else:
+                reload.append(title)
+
+        with ThreadPoolExecutor(max_workers=self._fetch_workers) as executor:
+            results = executor.map(lambda args: self._diff_sections(*args),
+                                   diffs)
+            for (title, _, _, newrev), outline in zip(diffs, results):
+                if outline is None:
+                    reload.append(title)
+                else:
+                    outlines[title], revids[title] = outline, newrev
+
+            self._logger.debug(
+                "Fetching sections for %s pages (%s from diffs)", len(titles),
+                len(titles) - len(reload))
+
+            chunksize = 50
+            chunks = list(chunked(reload, chunksize))
+            pending = {}
+            for pages in executor.map(self._load_pages, chunks):
+                for title, revid, text in pages:
+                    if title not in timestamps:
+                        continue
+                    pairs = scan_sections(text)
+                    if pairs is None:
+                        pending[title] = (revid, text, self._parse(text))
+                    else:
+                        outlines[title] = self._make_outline(text, pairs)
+                        revids[title] = revid
+
+        for title, (revid, text, future) in pending.items():
+            try:
+                outlines[title] = self._make_outline(text, future.result())
+            except mwparserfromhell.parser.ParserError:
+                self._logger.exception("Failed to parse [[%s]]", title)
+            else:
+                revids[title] = revid
+
+        self._save_sections(outlines, revids, timestamps)
+
+    def _parse(self, text):
+        """Parse a page with the full parser, in the process pool if we can.
+
+        Return a future for a list of (name, timestamp) pairs.
+        """
+        if self._parsers:
+            return self._parsers.submit(parse_sections, text)
+
+        future = Future()
+        try:
+            future.set_result(parse_sections(text))
+        except mwparserfromhell.parser.ParserError as exc:
+            future.set_exception(exc)
+        return future
+
     def _get_updated_discussions(self, start, end):
         """Return a dict mapping talk page titles to lists of section tuples.
 
         The only pages included in the dict are those that have been updated
         in the given time range.
+
+        Changes are streamed from recentchanges in chunks. The sections of
+        each chunk's pages are stored in the local database before moving on
+        to the next one, so an interrupted run picks up where it stopped.
         """
-        query = """
-        SELECT DISTINCT rc_namespace, rc_title
-        FROM recentchanges
-        WHERE rc_timestamp >= ? AND rc_timestamp < ?
-        AND rc_namespace % 2 = 1 AND rc_namespace != 3
-        AND rc_source IN ('mw.edit', 'mw.new', 'mw.log')
-        AND rc_bot = 0
-        """
+        conditions = """rc_namespace % 2 = 1 AND rc_namespace != 3
+            AND rc_source IN ('mw.edit', 'mw.new', 'mw.log')
+            AND rc_bot = 0"""
 
-        startts = start.strftime("%Y%m%d%H%M%S")
-        endts = end.strftime("%Y%m%d%H%M%S")
         self._logger.info("Fetching discussions updated between %s and %s",
-                          startts, endts)
+                          start.strftime("%Y%m%d%H%M%S"),
+                          end.strftime("%Y%m%d%H%M%S"))
 
-        with self._bot.wikidb as cursor:
-            cursor.execute(query, (startts, endts))
-            titles = [join_full_title(self._bot.site, ns, title.decode("utf8"))
-                      for (ns, title) in cursor.fetchall()]
-
-        self._logger.debug("Fetching sections for %s pages", len(titles))
-
-        sections = {}
-        chunksize = 50
-        for start in range(0, len(titles), chunksize):
-            chunk = titles[start:start+chunksize]
-            pages = self._load_pages(chunk)
-            for title, text in pages:
-                try:
-                    sections[title] = self._extract_sections(text)
-                except mwparserfromhell.parser.ParserError:
-                    self._logger.exception("Failed to parse [[%s]]", title)
+        reader = RecentChangesReader(
+            self._bot, self.UPDATE_KEY,
+            ["rc_namespace", "rc_title", "rc_this_oldid"],
+            conditions=conditions, chunksize=self.CHANGES_PER_CHUNK)
+        for changes in reader.read(start, end):
+            self._process_changes(changes)
 
-        return sections
+        return self._load_sections(start)
 
     def _get_current_discussions(self, title):
         """Return a dict mapping talk page titles to lists of section tuples.
@@ -139,15 +631,141 @@ class NewDiscussions(Task):
 
         return discussions
 
-    def _process_discussions(self, pages, current, updated):
+    def _load_published(self):
+        """Return the discussions we last published for each project.
+
+        The result maps project names to dicts like those returned by
+        _get_current_discussions().
+        """
+        query = """SELECT dl_project, dl_discussions
+            FROM discussion_lists
+            WHERE dl_site = ?"""
+        fmt = "%Y%m%d%H%M%S"
+
+        with self._bot.localdb as cursor:
+            cursor.execute(query, (self._bot.wikiid,))
+            results = cursor.fetchall()
+
+        published = {}
+        for project, data in results:
+            published[project.decode("utf8")] = {
+                title: {_Section(name, datetime.strptime(stamp, fmt))
+                        for (name, stamp) in secs}
+                for (title, secs) in json.loads(data).items()}
+        return published
+
+    def _save_published(self, project, discussions):
+        """Record the list of discussions just published for a project."""
+        query = """INSERT INTO discussion_lists
+            (dl_site, dl_project, dl_discussions)
+            VALUES (?, ?, ?)
+            ON DUPLICATE KEY UPDATE dl_discussions = VALUES(dl_discussions)"""
+
+        listed = {}
+        for disc in discussions:
+            listed.setdefault(disc.title, []).append(
+                (disc.name, disc.timestamp.strftime("%Y%m%d%H%M%S")))
+
+        with self._bot.localdb as cursor:
+            cursor.execute(query, (self._bot.wikiid, project.name,
+                                   json.dumps(listed)))
+
+    def _get_previous_discussions(self, projects):
+        """Return a dict mapping project names to their listed discussions.
+
+        Lists normally come from what we stored when we last published them.
+        The wiki pages are read instead for projects we have no record of,
+        and for every project once per CHECK_INTERVAL, in case someone edited
+        a list by hand.
+        """
+        published = self._load_published()
+        last_check = self._bot.get_last_updated(self.CHECK_KEY)
+        check = last_check < datetime.utcnow() - self.CHECK_INTERVAL
+
+        toread = {project.name for project in projects
+                  if check or project.name not in published}
+        self._bot.prefetch_pages([name + "/Discussions" for name in toread])
+
+        previous = {}
+        for project in projects:
+            if project.name not in toread:
+                previous[project.name] = published[project.name]
+                continue
+
+            current = self._get_current_discussions(
+                project.name + "/Discussions")
+            if project.name in published and (
+                    published[project.name] != current):
+                self._logger.info("Discussion list for %s was changed on-wiki",
+                                  project.name)
+            previous[project.name] = current
+
+        if check:
+            self._bot.set_last_updated(self.CHECK_KEY)
+        return previous
+
+    def _get_talk_ids(self, titles):
+        """Return a dict mapping the page IDs of the given talk pages to titles.
+
+        Titles are matched exactly on the replica. Pages that don't exist are
+        left out.
+        """
+        query = """SELECT page_id, page_title
+            FROM page
+            WHERE page_namespace = ? AND page_title IN ({})"""
+
+        bynamespace = {}
+        for title in titles:
+            ns, sqltitle = split_full_title(self._bot.site, title)
+            if ns % 2 == 1:
+                bynamespace.setdefault(ns, {})[sqltitle] = title
+
+        talkids = {}
+        chunksize = 1000
+        with self._bot.wikidb as cursor:
+            for ns, nstitles in bynamespace.items():
+                for chunk in chunked(list(nstitles), chunksize):
+                    cursor.execute(query.format(", ".join("?" * len(chunk))),
+                                   [ns] + chunk)
+                    for pageid, sqltitle in cursor.fetchall():
+                        talkids[pageid] = nstitles[sqltitle.decode("utf8")]
+        return talkids
+
+    def _get_memberships(self, titles):
+        """Return a dict mapping talk page titles to sets of project names.
+
+        Memberships are looked up in the project index by talk page ID, only
+        for the given titles, so the cost depends on how many pages changed
+        rather than on the size of the projects. Using IDs rather than titles
+        avoids the index's case- and accent-insensitive title matching.
+        """
+        query = """SELECT page_talk_id, project_title
+            FROM {0}_page
+            JOIN {0}_index ON index_page = page_id
+            JOIN {0}_project ON index_project = project_id
+            WHERE page_talk_id IN ({1})"""
+
+        talkids = self._get_talk_ids(titles)
+        memberships = {}
+        chunksize = 1000
+        with self._bot.localdb as cursor:
+            for chunk in chunked(list(talkids), chunksize):
+                cursor.execute(query.format(
+                    self._bot.wikiid, ", ".join("?" * len(chunk))), chunk)
+                for talkid, project in cursor.fetchall():
+                    memberships.setdefault(talkids[talkid], set()).add(project)
+        return memberships
+
+    def _process_discussions(self, project, current, updated, memberships):
         """Return a sorted list of the most recent discussion tuples."""
         sections = {}
 
-        for page in pages:
-            title = join_full_title(self._bot.site, page.ns + 1, page.title)
+        for title in set(updated) | set(current):
+            if project.name not in memberships.get(title, ()):
+                continue
             if title in updated:
                 sections[title] = updated[title]
-            elif title in current:
+            else:
                 sections[title] = current[title]
 
         discussions = [_Discussion(title, section.name, section.timestamp)
@@ -195,8 +813,7 @@ class NewDiscussions(Task):
 
         projtalk = self._bot.get_page(project.name).toggleTalkPage().title()
 
-        page = self._bot.get_page(title)
-        page.text = text % {
+        text = text % {
             "title": title,
             "projname": project.name,
             "projtalk": projtalk,
@@ -206,26 +823,49 @@ class NewDiscussions(Task):
         summary = "Updating new discussions"
         if news:
             summary += ": " + ", ".join("[[%s]]" % item for item in news)
-        page.save(summary, minor=False)
+        self._bot.publisher.publish(title, text, summary)
 
-    def _process(self, project, updated):
+    def _process(self, project, current, updated, memberships):
         """Process new discussions for the given project."""
         self._logger.debug("Updating new discussions for %s", project.name)
         title = project.name + "/Discussions"
 
-        pages = project.get_members()
-        current = self._get_current_discussions(title)
-        discussions, news = self._process_discussions(pages, current, updated)
+        discussions, news = self._process_discussions(
+            project, current, updated, memberships)
         self._save_discussions(project, title, discussions, news)
+        self._save_published(project, discussions)
 
     def run(self):
-        start = self._bot.get_last_updated("new_discussions")
+        start = self._bot.get_last_updated(self.UPDATE_KEY)
         end = datetime.utcnow()
-        updated = self._get_updated_discussions(start, end)
+        if self._parse_workers == 0:
+            updated = self._get_updated_discussions(start, end)
+        else:
+            # Forking could copy locks held by other threads, so workers are
+            # started from a separate single-threaded server process instead:
+            context = multiprocessing.get_context("forkserver")
+            with ProcessPoolExecutor(self._parse_workers,
+                                     mp_context=context) as parsers:
+                self._parsers = parsers
+                updated = self._get_updated_discussions(start, end)
+            self._parsers = None
 
         self._logger.info("Updating discussion reports")
-        for project in self._bot.get_configured_projects():
-            if project.config.get("new_discussions"):
-                self._process(project, updated)
-
-        self._bot.set_last_updated("new_discussions", end)
+        projects = self._bot.get_configured_projects("new_discussions")
+        currents = self._get_previous_discussions(projects)
+        self._bot.publisher.prepare([project.name + "/Discussions"
+                                     for project in projects])
+        titles = set(updated)
+        for current in currents.values():
+            titles |= set(current)
+        memberships = self._get_memberships(list(titles))
+
+        for project in projects:
+            self._process(project, currents[project.name], updated,
+                          memberships)
+        self._logger.info("Reports: %(saved)s saved, %(skipped)s skipped by "
+                          "digest, %(unchanged)s unchanged",
+                          self._bot.publisher.stats)
+
+        self._bot.set_last_updated(self.UPDATE_KEY, end)
+        self._prune_state(end - self.STATE_LIFETIME)
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+
+"""
+Rebuilds the WikiProject index from scratch instead of incrementally
+Copyright (C) 2015 James Hare, 2016 Ben Kurtovic
+Licensed under MIT License: http://mitlicense.org
+"""
+
+from os import path
+
+from reportsbot.runner import find_task
+
+__all__ = ["RebuildProjectIndex"]
+
+UpdateProjectIndex = find_task("update_project_index", path.dirname(__file__))
+
+class RebuildProjectIndex(UpdateProjectIndex):
+    """Rebuilds the index of articles associated with each WikiProject."""
+    PROVIDES = ("update_project_index",)
+    FULL_REBUILD = True
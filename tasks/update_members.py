@@ -6,8 +6,10 @@ Copyright (C) 2015 James Hare, 2016 Ben Kurtovic
 Licensed under MIT License: http://mitlicense.org
 """
 
+from time import sleep
+
 from reportsbot.task import Task
-from reportsbot.util import to_wiki_format
+from reportsbot.util import chunked, to_sql_format, to_wiki_format
 
 import mwparserfromhell
 
@@ -15,7 +17,15 @@ __all__ = ["UpdateMembers"]
 
 class UpdateMembers(Task):
     """Updates WikiProject member lists based on WikiProjectCard usage."""
+    REQUIRES = ("load_project_config",)
     MEMBER_TEMPLATE = "WikiProjectCard"
+    UPDATE_KEY = "update_members"
+
+    def __init__(self, bot):
+        super().__init__(bot)
+        config = bot.config.get_task_config(self.UPDATE_KEY)
+        self._max_migrations = config.get("max_migrations", 100)
+        self._migration_delay = config.get("migration_delay", 5)
 
     def _migrate_card(self, title, project):
         """Migrate the card at the given title to the given project."""
@@ -34,17 +44,66 @@ class UpdateMembers(Task):
         card.text = str(code)
         card.save("Updating WikiProject name", minor=True)
 
-    def _follow_project_redirect(self, title):
-        """Return the redirect target of the given project, if it exists."""
-        page = self._bot.get_page(title)
-        if page.isRedirectPage():
-            target = page.getRedirectTarget().title()
-            if self._bot.get_project(target).configured:
-                return target.split(":", 1)[1]
-        return None
+    def _migrate_cards(self, queue):
+        """Migrate queued cards, and return a list of those that were moved.
+
+        *queue* is a list of (title, username, project) tuples. At most
+        max_migrations cards are moved per run, with a pause of
+        migration_delay seconds between moves; the rest are left for the next
+        run.
+        """
+        if len(queue) > self._max_migrations:
+            self._logger.info("Deferring %s card migrations to the next run",
+                              len(queue) - self._max_migrations)
+            queue = queue[:self._max_migrations]
+
+        migrated = []
+        for index, (title, username, project) in enumerate(queue):
+            if index:
+                sleep(self._migration_delay)
+            self._migrate_card(title, project)
+            migrated.append((username, project))
+        return migrated
+
+    def _resolve_project_redirects(self, projects):
+        """Return a dict mapping unconfigured projects to configured ones.
+
+        Each project name is looked up on the replica along with its redirect
+        target, if any. Projects that aren't redirects to a configured project
+        are left out.
+        """
+        query = """SELECT page_title, rd_title
+            FROM page
+            JOIN redirect ON rd_from = page_id
+            WHERE page_namespace = 4 AND rd_namespace = 4
+            AND (rd_interwiki IS NULL OR rd_interwiki = '')
+            AND page_title IN ({})"""
+
+        names = {to_sql_format(project): project for project in projects}
+        sqlnames = list(names)
+        chunksize = 1000
+        ns_name = self._bot.site.namespaces.PROJECT.custom_name + ":"
+
+        targets = {}
+        with self._bot.wikidb as cursor:
+            for chunk in chunked(sqlnames, chunksize):
+                cursor.execute(query.format(", ".join("?" * len(chunk))),
+                               chunk)
+                for title, target in cursor.fetchall():
+                    target = to_wiki_format(None, target.decode("utf8"),
+                                            ignore_ns=True)
+                    if self._bot.get_project(ns_name + target).configured:
+                        targets[names[title.decode("utf8")]] = target
+        return targets
 
     def _get_all_members(self):
-        """Return a dict mapping projects to lists of members (usernames)."""
+        """Return a dict mapping projects to lists of members (usernames).
+
+        This works in two phases: cards are first collected from the replica,
+        then any that name unconfigured projects are resolved in bulk through
+        project redirects. Cards for redirected projects are queued to be
+        moved, and their users are only listed once the move has been made.
+        """
         self._logger.debug("Fetching member lists")
 
         query = """
@@ -56,6 +115,8 @@ class UpdateMembers(Task):
         """
 
         members = {}
+        unknown = []
+        configured = {}
         with self._bot.wikidb as cursor:
             cursor.execute(query, (self.MEMBER_TEMPLATE,))
             for row in cursor.fetchall():
@@ -72,31 +133,43 @@ class UpdateMembers(Task):
                 username = components[0]
                 project = to_wiki_format(None, components[2], ignore_ns=True)
 
-                proj_title = "Project:" + project
-                if not self._bot.get_project(proj_title).configured:
-                    project = self._follow_project_redirect(proj_title)
-                    if not project:
-                        continue
-                    self._migrate_card(title, project)
+                if project not in configured:
+                    proj_title = "Project:" + project
+                    configured[project] = self._bot.get_project(
+                        proj_title).configured
+                if not configured[project]:
+                    unknown.append((title, username, project))
+                    continue
+
+                members.setdefault(project, []).append(username)
 
-                if project in members:
-                    members[project].append(username)
-                else:
-                    members[project] = [username]
+        if unknown:
+            targets = self._resolve_project_redirects(
+                {project for (_, _, project) in unknown})
+            queue = [(title, username, targets[project])
+                     for (title, username, project) in unknown
+                     if project in targets]
+            for username, project in self._migrate_cards(queue):
+                members.setdefault(project, []).append(username)
 
         self._logger.info("%s total members in %s projects",
                           sum(len(L) for L in members.values()), len(members))
 
         return {project: sorted(users) for project, users in members.items()}
 
+    def _get_list_titles(self, project):
+        """Return the titles of a project's active and inactive member lists."""
+        ns_name = self._bot.site.namespaces.PROJECT.custom_name + ":"
+        return (ns_name + project + "/Members",
+                ns_name + project + "/Members/Inactive")
+
     def _update_project(self, project, members):
         """Update the active and inactive member lists for a single project."""
         self._logger.debug("Updating project: %s (%s members)", project,
                            len(members))
 
         ns_name = self._bot.site.namespaces.PROJECT.custom_name + ":"
-        active_title = ns_name + project + "/Members"
-        inactive_title = ns_name + project + "/Members/Inactive"
+        active_title, inactive_title = self._get_list_titles(project)
 
         return_to_wikiproject = "{{Clickable button 2|%s%s|Return to WikiProject|class=mw-ui-neutral}}<span class='wp-formsGadget mw-ui-button mw-ui-progressive' data-mode='create' data-type='Join'>Join WikiProject</span>" % (ns_name, project)
         lua_garbage = "{{#invoke:<includeonly>random|list|limit=3</includeonly><noinclude>list|unbulleted</noinclude>|"
@@ -113,20 +186,25 @@ class UpdateMembers(Task):
         active = active[:-1] + "}}"  # removing trailing pipe and closing off module
         inactive += "}}"
 
-        page_active = self._bot.get_page(active_title)
-        page_inactive = self._bot.get_page(inactive_title)
-
-        if active != page_active.text:
-            self._logger.debug("Saving active members: [[%s]]", active_title)
-            page_active.text = active
-            page_active.save("Updating member list", minor=False)
-
-        if inactive != page_inactive.text:
-            self._logger.debug("Saving inactive members: [[%s]]", inactive_title)
-            page_inactive.text = inactive
-            page_inactive.save("Updating member list", minor=False)
+        publisher = self._bot.publisher
+        if publisher.publish(active_title, active, "Updating member list"):
+            self._logger.debug("Saved active members: [[%s]]", active_title)
+        if publisher.publish(inactive_title, inactive, "Updating member list"):
+            self._logger.debug("Saved inactive members: [[%s]]",
+                               inactive_title)
 
     def run(self):
         members = self._get_all_members()
+        active = self._bot.activity.check(
+            {user for users in members.values() for user in users})
+        self._logger.info("%s active members", len(active))
+
+        self._bot.publisher.prepare([
+            title for project in members
+            for title in self._get_list_titles(project)])
         for project in members:
             self._update_project(project, members[project])
+
+        self._logger.info("Member lists: %(saved)s saved, %(skipped)s "
+                          "skipped by digest, %(unchanged)s unchanged",
+                          self._bot.publisher.stats)
@@ -6,14 +6,23 @@ Copyright (C) 2015 James Hare, 2016 Ben Kurtovic
 Licensed under MIT License: http://mitlicense.org
 """
 
-from collections import namedtuple
+from array import array
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timedelta
+from hashlib import sha1
+from os import path
+from queue import Queue
 import re
+from threading import Thread
 
-from BTrees.IIBTree import IIBTree
+import oursql
 from oursql import ProgrammingError
 
+from reportsbot.bulk import BulkWriter
+from reportsbot.exceptions import ConfigError
+from reportsbot.talkmap import TalkMap
 from reportsbot.task import Task
-from reportsbot.util import join_full_title
+from reportsbot.util import chunked, join_full_title
 
 __all__ = ["UpdateProjectIndex"]
 
@@ -21,13 +30,53 @@ Project = namedtuple("Project", ["id", "title", "categories"])
 Page = namedtuple("Page", ["id", "talkid", "ns", "title", "isredir"])
 
 class UpdateProjectIndex(Task):
-    """Updates the index of articles associated with each WikiProject."""
+    """Updates the index of articles associated with each WikiProject.
+
+    By default, only pages that changed since the last run are reprocessed. A
+    full rebuild is done when no previous run is recorded, when the last run is
+    too old to be covered by recentchanges, or when FULL_REBUILD is set (see
+    the rebuild_project_index task).
+
+    Incremental updates can't see a talk page leave a project category
+    because a template it transcludes was edited: categorylinks keeps no
+    timestamp for removals, and the talk page itself doesn't appear in
+    recentchanges. Such pages stay indexed until the next full rebuild, so
+    one is also done whenever the last one is older than rebuild_days (from
+    this task's config; 7 by default). Pages of projects whose set of
+    categories changed are all rechecked, since joining or leaving a
+    project that way doesn't touch their categorylinks rows.
+    """
+    UPDATE_KEY = "update_project_index"
+    REBUILD_KEY = "update_project_index_rebuild"
+    FRESHNESS = timedelta(hours=12)
+    FULL_REBUILD = False
+    MAX_INCREMENTAL_AGE = timedelta(days=25)  # recentchanges keeps ~30 days
+    WRITE_ATTEMPTS = 3
+    CHUNKSIZE = 10000
 
     def __init__(self, bot):
         super().__init__(bot)
         self._page_table = bot.wikiid + "_page"
         self._project_table = bot.wikiid + "_project"
         self._index_table = bot.wikiid + "_index"
+        self._talkmap_file = path.join(
+            bot.config.cache_dir, bot.wikiid + ".talkmap")
+        self._infile = bool(bot.config.get_local_sql().get("local_infile"))
+        self._write_stats = OrderedDict()
+        config = bot.config.get_task_config(self.UPDATE_KEY)
+        self._rebuild_interval = timedelta(days=config.get("rebuild_days", 7))
+        self._workers = config.get("workers", 1)
+        if not isinstance(self._workers, int) or self._workers < 1:
+            err = "Invalid number of workers for {}: {!r} (must be at least 1)"
+            raise ConfigError(err.format(self.UPDATE_KEY, self._workers))
+        if self._workers >= bot.config.sql_pool_size:
+            # The main thread keeps its own local connection while the
+            # workers run, and each worker holds one until it exits:
+            err = ("{} workers for {} need an SQL pool_size of at least {} "
+                   "(currently {})")
+            raise ConfigError(err.format(
+                self._workers, self.UPDATE_KEY, self._workers + 1,
+                bot.config.sql_pool_size))
 
     def _create_tables(self, cursor):
         """Create this wiki's various tables, using base_* as references."""
@@ -45,7 +94,10 @@ class UpdateProjectIndex(Task):
         cursor.execute(query2.format(self._index_table, "base_index"))
 
     def _ensure_tables(self):
-        """Ensure that all necessary tables exist for this wiki."""
+        """Ensure that all necessary tables exist for this wiki.
+
+        Return True if the tables had to be created, and False otherwise.
+        """
         query = "SELECT 1 FROM {} LIMIT 1"
         with self._bot.localdb as cursor:
             try:
@@ -54,6 +106,8 @@ class UpdateProjectIndex(Task):
                 cursor.execute(query.format(self._index_table))
             except ProgrammingError:
                 self._create_tables(cursor)
+                return True
+        return False
 
     def _get_project_categories(self):
         """Return a list of Wikiproject classification categories."""
@@ -69,8 +123,49 @@ class UpdateProjectIndex(Task):
             cursor.execute(query)
             return [cat.decode("utf8") for (cat,) in cursor.fetchall()]
 
-    def _find_project(self, cursor, name):
-        """Return the ID and title of the given WikiProject's root page.
+    def _load_project_pages(self, cursor, names):
+        """Load candidate WikiProject root pages from the Project namespace.
+
+        We load every page whose title starts with "WikiProject", plus any
+        page whose title exactly matches one of the given name fragments.
+
+        The return value is a 2-tuple of (titles, subpages). *titles* maps
+        page titles to (page_id, redirect_ns, redirect_title) tuples.
+        *subpages* maps the final component of each first-level WikiProject
+        subpage (like "Insects" for "WikiProject_Biology/Insects") to a list
+        of the full titles that end with it.
+        """
+        query1 = r"""SELECT page_id, page_title, rd_namespace, rd_title
+            FROM page LEFT JOIN redirect ON rd_from = page_id
+            WHERE page_namespace = 4
+            AND page_title LIKE "WikiProject|_%" ESCAPE '|'"""
+        query2 = """SELECT page_id, page_title, rd_namespace, rd_title
+            FROM page LEFT JOIN redirect ON rd_from = page_id
+            WHERE page_namespace = 4 AND page_title IN ({})"""
+
+        def _load(results):
+            for pid, title, rns, rtitle in results:
+                rtitle = rtitle.decode("utf8") if rtitle else None
+                titles[title.decode("utf8")] = (pid, rns, rtitle)
+
+        titles = {}
+        cursor.execute(query1)
+        _load(cursor.fetchall())
+        for chunk in chunked(names, self.CHUNKSIZE):
+            cursor.execute(query2.format(", ".join("?" * len(chunk))), chunk)
+            _load(cursor.fetchall())
+
+        subpages = {}
+        for title in titles:
+            if title.startswith("WikiProject_") and title.count("/") == 1:
+                subpages.setdefault(title.split("/")[1], []).append(title)
+
+        self._logger.debug("Loaded %s candidate project pages", len(titles))
+        return titles, subpages
+
+    @staticmethod
+    def _match_fragment(titles, subpages, name):
+        """Return the title of the page matching the given name fragment.
 
         This function accepts a project name "fragment" that has been extracted
         from a category name. For example, we might get "Insects" from
@@ -79,50 +174,175 @@ class UpdateProjectIndex(Task):
         we try a number of candidate titles in the Project namespace, including
         prepending "WikiProject" to it and checking whether it exists as a task
         force within a larger project. If any of those yield a definitive
-        match, we'll return it.
+        match, we'll return it; otherwise, we return None.
         """
-        query1 = """SELECT page_id, page_namespace, page_title,
-                rd_namespace, rd_title
-            FROM page LEFT JOIN redirect ON rd_from = page_id
-            WHERE page_title LIKE ? ESCAPE "|" AND page_namespace = 4"""
-        query2 = """SELECT page_id
+        for title in ("WikiProject_" + name, "WikiProject_" + name + "s",
+                      name):
+            if title in titles:
+                return title
+
+        for key in (name + "_task_force", name):
+            matches = subpages.get(key, [])
+            if len(matches) == 1:  # Need a definitive result
+                return matches[0]
+
+        return None
+
+    def _resolve_projects(self, cursor, names):
+        """Return a dict mapping name fragments to their WikiProjects.
+
+        Each value is a 2-tuple of (project_id, project_title), or None if the
+        fragment doesn't correspond to a WikiProject. Redirects are followed.
+        """
+        query = """SELECT page_id, page_namespace, page_title
             FROM page
-            WHERE page_namespace = ? AND page_title = ?"""
-
-        escname = name.replace("_", "|_")
-        candidates = (
-            "WikiProject|_%s" % escname,
-            "WikiProject|_%ss" % escname,
-            escname,
-            "WikiProject|_%%/%s|_task|_force" % escname,
-            "WikiProject|_%%/%s" % escname
-        )
-
-        for candidate in candidates:
-            cursor.execute(query1, (candidate,))
-            results = cursor.fetchall()
-            if "%" in candidate:
-                # If this was a wildcard search, we want to make sure we didn't
-                # accidentally pick up a subpage of a subpage:
-                results = [res for res in results
-                           if res[2].decode("utf8").count("/") <= 1]
-            if len(results) == 1:  # Need a definitive result
-                break
-        else:
-            raise ValueError(name)
+            WHERE page_namespace = ? AND page_title IN ({})"""
+
+        titles, subpages = self._load_project_pages(cursor, names)
+        matches = {name: self._match_fragment(titles, subpages, name)
+                   for name in names}
+
+        targets = {}
+        for title in set(matches.values()) - {None}:
+            _, rns, rtitle = titles[title]
+            if rns is not None and rtitle:
+                targets.setdefault(rns, set()).add(rtitle)
+
+        found = {}
+        for rns, rtitles in targets.items():
+            for chunk in chunked(list(rtitles), self.CHUNKSIZE):
+                params = ", ".join("?" * len(chunk))
+                cursor.execute(query.format(params), [rns] + chunk)
+                for pid, ns, title in cursor.fetchall():
+                    found[(ns, title.decode("utf8"))] = pid
+
+        resolved = {}
+        for name, title in matches.items():
+            if title is None:
+                resolved[name] = None
+                continue
 
-        pid, ns, title, rns, rtitle = results[0]
-        if rns and rtitle:
-            cursor.execute(query2, (rns, rtitle))
-            result = cursor.fetchall()
-            if not result:  # Broken redirect?
-                raise ValueError(name)
-            pid = result[0][0]
-            ns, title = rns, rtitle
+            pid, ns = titles[title][0], 4
+            rns, rtitle = titles[title][1:]
+            if rns is not None and rtitle:
+                if (rns, rtitle) not in found:  # Broken redirect?
+                    resolved[name] = None
+                    continue
+                pid, ns, title = found[(rns, rtitle)], rns, rtitle
+
+            resolved[name] = (pid, join_full_title(self._bot.site, ns, title))
+
+        return resolved
+
+    @staticmethod
+    def _get_affected_fragments(title):
+        """Return the name fragments whose resolution a title could affect."""
+        fragments = {title}
+        if title.startswith("WikiProject_"):
+            rest = title[len("WikiProject_"):]
+            if "/" not in rest:
+                fragments.add(rest)
+                if rest.endswith("s"):
+                    fragments.add(rest[:-1])
+            elif rest.count("/") == 1:
+                sub = rest.split("/")[1]
+                fragments.add(sub)
+                if sub.endswith("_task_force"):
+                    fragments.add(sub[:-len("_task_force")])
+        return fragments
+
+    def _invalidate_fragment_cache(self, since):
+        """Remove cache entries for fragments that may have changed.
+
+        If there was no previous update or it was too long ago, the whole
+        cache is cleared. Otherwise, we look at changes to Project namespace
+        pages since then, and drop fragments that could resolve differently,
+        as well as fragments that resolved to a page that has changed.
+        """
+        query1 = """SELECT rc_title, page_title, rc_cur_id
+            FROM recentchanges
+            LEFT JOIN page ON page_id = rc_cur_id AND page_namespace = 4
+            WHERE rc_timestamp >= ? AND rc_namespace = 4
+            AND rc_source IN ('mw.edit', 'mw.new', 'mw.log')"""
+        query2 = "DELETE FROM fragment_cache WHERE fc_site = ?"
+        query3 = """DELETE FROM fragment_cache
+            WHERE fc_site = ?
+            AND (fc_fragment IN ({}) OR fc_project_id IN ({}))"""
+
+        if self.FULL_REBUILD or not self._is_recent(since):
+            with self._bot.localdb as cursor:
+                cursor.execute(query2, (self._bot.wikiid,))
+            return
 
-        return pid, join_full_title(self._bot.site, ns, title.decode("utf8"))
+        fragments = set()
+        pageids = set()
+        with self._bot.wikidb as cursor:
+            cursor.execute(query1, (since.strftime("%Y%m%d%H%M%S"),))
+            for oldtitle, newtitle, pageid in cursor.fetchall():
+                for title in (oldtitle, newtitle):
+                    if title:
+                        fragments |= self._get_affected_fragments(
+                            title.decode("utf8"))
+                pageids.add(pageid)
+
+        self._logger.debug("Invalidating up to %s cached fragments",
+                           len(fragments))
+        fragments = [frag.encode("utf8") for frag in fragments]
+        pageids = list(pageids)
+        chunksize = 1000
+        total = max(len(fragments), len(pageids))
+        with self._bot.localdb as cursor:
+            for start in range(0, total, chunksize):
+                fchunk = fragments[start:start+chunksize] or [b""]
+                pchunk = pageids[start:start+chunksize] or [0]
+                params = (", ".join("?" * len(fchunk)),
+                          ", ".join("?" * len(pchunk)))
+                cursor.execute(query3.format(*params),
+                               [self._bot.wikiid] + fchunk + pchunk)
+
+    def _find_projects(self, names, since):
+        """Return a dict mapping name fragments to their WikiProjects.
+
+        Results are cached in the local database across runs. Only fragments
+        that aren't cached (or whose cache entries were invalidated due to
+        page changes) are resolved against the wiki.
+        """
+        query1 = """SELECT fc_fragment, fc_project_id, fc_project_title
+            FROM fragment_cache
+            WHERE fc_site = ?"""
+        query2 = """INSERT INTO fragment_cache
+            (fc_site, fc_fragment, fc_project_id, fc_project_title)
+            VALUES (?, ?, ?, ?)
+            ON DUPLICATE KEY UPDATE fc_project_id = VALUES(fc_project_id),
+                fc_project_title = VALUES(fc_project_title)"""
 
-    def _get_projects(self):
+        self._invalidate_fragment_cache(since)
+
+        with self._bot.localdb as cursor:
+            cursor.execute(query1, (self._bot.wikiid,))
+            cached = {frag.decode("utf8"): (pid, title) if pid else None
+                      for (frag, pid, title) in cursor.fetchall()}
+
+        missing = [name for name in names if name not in cached]
+        self._logger.debug("%s fragments cached, %s to resolve",
+                           len(names) - len(missing), len(missing))
+        if not missing:
+            return cached
+
+        with self._bot.wikidb as cursor:
+            resolved = self._resolve_projects(cursor, missing)
+
+        rows = [(self._bot.wikiid, name.encode("utf8")) +
+                (result if result else (None, None))
+                for name, result in resolved.items()]
+        with self._bot.localdb as cursor:
+            cursor.execute("BEGIN")
+            cursor.executemany(query2, rows)
+
+        cached.update(resolved)
+        return cached
+
+    def _get_projects(self, since):
         """Return a list of valid WikiProjects.
 
         Each project is a 3-tuple: (project_id, project_title, categories).
@@ -151,33 +371,46 @@ class UpdateProjectIndex(Task):
 
         # Build the Project objects:
         projects = {}
-        with self._bot.wikidb as cursor:
-            for name, cats in catmap.items():
-                try:
-                    pid, title = self._find_project(cursor, name)
-                except ValueError:
-                    msg = "Rejecting project: %s (%s categories, first: %s)"
-                    self._logger.debug(msg, name, len(cats), cats[0])
-                    continue
+        resolved = self._find_projects(list(catmap.keys()), since)
+        for name, cats in catmap.items():
+            if not resolved.get(name):
+                msg = "Rejecting project: %s (%s categories, first: %s)"
+                self._logger.debug(msg, name, len(cats), cats[0])
+                continue
 
-                if pid in projects:
-                    projects[pid].categories.extend(cats)
-                else:
-                    projects[pid] = Project(pid, title, cats)
+            pid, title = resolved[name]
+            if pid in projects:
+                projects[pid].categories.extend(cats)
+            else:
+                projects[pid] = Project(pid, title, cats)
 
         msg = "%s projects with %s total categories"
         total_cats = sum(len(proj.categories) for proj in projects.values())
         self._logger.info(msg, len(projects), total_cats)
         return list(projects.values())
 
+    @staticmethod
+    def _get_category_digest(project):
+        """Return a digest identifying the given project's set of categories."""
+        return sha1("\n".join(sorted(set(project.categories))).encode(
+            "utf8")).digest()
+
     def _really_sync_projects(self, cursor, projects):
-        """Really update the given projects inside an SQL transaction."""
-        query1 = "SELECT project_id, project_title FROM {}"
+        """Really update the given projects inside an SQL transaction.
+
+        Return the set of IDs of projects that were newly added or whose
+        categories changed.
+        """
+        query1 = """SELECT project_id, project_title, project_categories
+            FROM {}"""
         query2 = """DELETE {0}, {1}
             FROM {0} LEFT JOIN {1} ON project_id = index_project
             WHERE project_id = ?"""
-        query3 = "INSERT INTO {} (project_id, project_title) VALUES (?, ?)"
-        query4 = "UPDATE {} SET project_title = ? WHERE project_id = ?"
+        query3 = """INSERT INTO {}
+            (project_id, project_title, project_categories)
+            VALUES (?, ?, ?)"""
+        query4 = """UPDATE {} SET project_title = ?, project_categories = ?
+            WHERE project_id = ?"""
 
         query1 = query1.format(self._project_table)
         query2 = query2.format(self._project_table, self._index_table)
@@ -185,116 +418,236 @@ class UpdateProjectIndex(Task):
         query4 = query4.format(self._project_table)
 
         cursor.execute(query1)
-        old = dict(cursor.fetchall())
-        new = {proj.id: proj.title for proj in projects}
+        old = {pid: (title, digest)
+               for (pid, title, digest) in cursor.fetchall()}
+        new = {proj.id: (proj.title, self._get_category_digest(proj))
+               for proj in projects}
 
         to_remove = old.keys() - new.keys()
         to_add = new.keys() - old.keys()
         to_update = [pid for pid in new.keys() & old.keys()
                      if new[pid] != old[pid]]
+        recategorized = {pid for pid in to_update
+                         if new[pid][1] != old[pid][1]}
 
         for pid in to_remove:
-            self._logger.debug("Remove: %s: %s", pid, old[pid])
+            self._logger.debug("Remove: %s: %s", pid, old[pid][0])
         for pid in to_add:
-            self._logger.debug("Add:    %s: %s", pid, new[pid])
+            self._logger.debug("Add:    %s: %s", pid, new[pid][0])
         for pid in to_update:
-            self._logger.debug("Update: %s: %s -> %s", pid, old[pid], new[pid])
+            self._logger.debug("Update: %s: %s -> %s", pid, old[pid][0],
+                               new[pid][0])
 
         msg = "Remove/add/update: %s/%s/%s"
         self._logger.info(msg, len(to_remove), len(to_add), len(to_update))
 
         cursor.executemany(query2, [(pid,) for pid in to_remove])
-        cursor.executemany(query3, [(pid, new[pid]) for pid in to_add])
-        cursor.executemany(query4, [(new[pid], pid) for pid in to_update])
+        cursor.executemany(query3, [(pid,) + new[pid] for pid in to_add])
+        cursor.executemany(query4, [new[pid] + (pid,) for pid in to_update])
+        return to_add | recategorized
 
     def _sync_projects(self, projects):
-        """Synchronize the given projects with the database."""
+        """Synchronize the given projects with the database.
+
+        Return the set of IDs of projects that were newly added or whose
+        categories changed, like when a category page was created or a name
+        fragment newly resolved to the project.
+        """
         self._logger.info("Synchronizing projects")
 
         with self._bot.localdb as cursor:
             cursor.execute("BEGIN")
-            self._really_sync_projects(cursor, projects)
+            return self._really_sync_projects(cursor, projects)
 
-    def _get_talkmap(self, cursor):
-        """Return a dict mapping talk page IDs to subject page IDs.
-
-        Actually, this is misleading. The map also stores whether the subject
-        page is a redirect, and for maximum space efficiency, we do this by
-        shifting the subject page ID right by one bit and storing the boolean
-        in the least significant bit.
-        """
+    def _build_talkmap(self, cursor, mark):
+        """Return a new TalkMap containing every talk page on the wiki."""
         self._logger.info("Building talkmap")
 
         query = """SELECT talk.page_id, subj.page_id, subj.page_is_redirect
         FROM page AS talk
         INNER JOIN page AS subj ON talk.page_title = subj.page_title
             AND talk.page_namespace = subj.page_namespace + 1
-        WHERE talk.page_namespace % 2 = 1"""
+        WHERE talk.page_namespace % 2 = 1
+        ORDER BY talk.page_id"""
+
+        def _rows():
+            count = 0
+            while True:
+                resultset = cursor.fetchmany(100000)
+                if not resultset:
+                    break
+
+                self._logger.debug(
+                    "Fetched chunk (%s+%s)", count, len(resultset))
+                count += len(resultset)
+                for talkid, subjectid, isredir in resultset:
+                    yield talkid, (subjectid << 1) | isredir
 
-        talkmap = IIBTree()
         cursor.execute(query)
         self._logger.debug("Fetching result chunks")
-        while True:
-            resultset = cursor.fetchmany(100000)
-            if not resultset:
-                break
-
-            self._logger.debug(
-                "Fetched chunk (%s+%s)", len(talkmap), len(resultset))
-            for talkid, subjectid, isredir in resultset:
+        return TalkMap.build(_rows(), mark)
+
+    def _refresh_talkmap(self, cursor, talkmap, mark):
+        """Apply changes to talk pages since the talkmap was last updated."""
+        self._logger.info("Refreshing talkmap from %s", talkmap.timestamp)
+
+        query = """SELECT talk.page_id, subj.page_id, subj.page_is_redirect
+        FROM page AS talk
+        INNER JOIN page AS subj ON talk.page_title = subj.page_title
+            AND talk.page_namespace = subj.page_namespace + 1
+        WHERE talk.page_namespace % 2 = 1 AND talk.page_id IN ({})"""
+
+        since = talkmap.timestamp
+        changed = self._get_changed_pages(cursor, {}, since)
+        talkids = self._get_changed_talk_ids(cursor, changed, since)
+        talkids |= {pageid for pageid in changed if pageid in talkmap}
+        self._logger.debug("%s talkmap entries to recheck", len(talkids))
+
+        for chunk in chunked(sorted(talkids), self.CHUNKSIZE):
+            cursor.execute(query.format(", ".join("?" * len(chunk))), chunk)
+            found = set()
+            for talkid, subjectid, isredir in cursor.fetchall():
                 talkmap[talkid] = (subjectid << 1) | isredir
+                found.add(talkid)
+            for talkid in set(chunk) - found:
+                talkmap.discard(talkid)
+
+        talkmap.save(self._talkmap_file, mark)
+
+    def _get_talkmap(self, cursor, mark):
+        """Return a TalkMap mapping talk page IDs to subject page IDs.
 
+        Actually, this is misleading. The map also stores whether the subject
+        page is a redirect, and for maximum space efficiency, we do this by
+        shifting the subject page ID left by one bit and storing the boolean
+        in the least significant bit.
+
+        The talkmap is persisted between runs. If a recent enough copy exists,
+        we memory-map it and only apply changes made since then; otherwise, we
+        rebuild it from scratch.
+        """
+        talkmap = TalkMap.load(self._talkmap_file)
+        if talkmap:
+            if self._is_recent(talkmap.timestamp):
+                self._refresh_talkmap(cursor, talkmap, mark)
+                return talkmap
+            talkmap.close()
+
+        talkmap = self._build_talkmap(cursor, mark)
+        talkmap.save(self._talkmap_file)
         return talkmap
 
-    def _get_pages_in_project(self, cursor, talkmap, project):
-        """Return a list of Page objects within the given project.
+    def _get_memberships(self, cursor, talkmap, projects):
+        """Return a dict mapping project IDs to arrays of talk page IDs.
+
+        Rather than querying each project's categories separately, we stream
+        categorylinks once for every project category and partition the rows
+        by project. Only talk pages in the talkmap (that is, talk pages with an
+        existing subject page) are kept. Arrays may contain duplicates.
+        """
+        self._logger.info("Fetching project memberships")
+
+        query = """SELECT cl_from, cl_to
+            FROM categorylinks
+            WHERE cl_type = "page" AND cl_to IN ({})"""
+
+        catmap = {cat: proj.id for proj in projects for cat in proj.categories}
+        members = {proj.id: array("I") for proj in projects}
+        count = 0
+
+        for chunk in chunked(sorted(catmap), 1000):
+            cursor.execute(query.format(", ".join("?" * len(chunk))), chunk)
+            while True:
+                resultset = cursor.fetchmany(100000)
+                if not resultset:
+                    break
+
+                count += len(resultset)
+                self._logger.debug("Fetched memberships (%s)", count)
+                for talkid, cat in resultset:
+                    if talkid in talkmap:
+                        members[catmap[cat.decode("utf8")]].append(talkid)
+
+        return members
+
+    def _get_pages(self, cursor, talkmap, talkids):
+        """Return a list of Page objects for the given talk page IDs.
 
         Each page is a 5-tuple of (subject_page_id, talk_page_id,
         subject_page_ns, title, subject_is_redirect).
         """
-        query = """SELECT DISTINCT page_id, page_namespace - 1, page_title
+        query = """SELECT page_id, page_namespace - 1, page_title
             FROM page
-            JOIN categorylinks ON cl_from = page_id
-            WHERE cl_type = "page" AND page_namespace % 2 = 1
-            AND cl_to IN ({})"""
+            WHERE page_id IN ({})"""
+
+        pages = []
+        for chunk in chunked(talkids, self.CHUNKSIZE):
+            cursor.execute(query.format(", ".join("?" * len(chunk))), chunk)
+            pages.extend(
+                Page(talkmap[talkid] >> 1, talkid, ns, title.decode("utf8"),
+                     bool(talkmap[talkid] & 1))
+                for (talkid, ns, title) in cursor.fetchall())
+        return pages
 
-        query = query.format(", ".join("?" * len(project.categories)))
-        cursor.execute(query, project.categories)
-        pages = [Page(talkmap[talkid] >> 1, talkid, ns, title.decode("utf8"),
-                      bool(talkmap[talkid] & 1))
-                 for (talkid, ns, title) in cursor.fetchall()
-                 if talkid in talkmap]
+    def _get_writer(self, cursor):
+        """Return a BulkWriter for the given local database cursor."""
+        return BulkWriter(cursor, infile=self._infile, stats=self._write_stats)
 
-        self._logger.debug("    %s pages", len(pages))
-        return pages
+    def _save_modified_pages(self, cursor, to_remove, to_add, to_update,
+                             project=None):
+        """Update modified pages in the database.
 
-    def _save_modified_pages(self, cursor, to_remove, to_add, to_update):
-        """Update modified pages in the database."""
+        Removed pages lose their index rows too. If *project* is given, only
+        its index rows are removed: other projects' rows may be written by
+        other workers at the same time, and are left to their own
+        _sync_index() calls.
+        """
         msg = "    remove/add/update: %s/%s/%s"
         self._logger.debug(msg, len(to_remove), len(to_add), len(to_update))
 
         query1 = """DELETE {0}, {1}
-            FROM {0} LEFT JOIN {1} ON page_id = index_page
-            WHERE page_talk_id = ?"""
-        query2 = """INSERT INTO {}
-            (page_id, page_talk_id, page_title, page_ns, page_is_redirect)
-            VALUES (?, ?, ?, ?, ?)"""
-        query3 = """UPDATE {}
-            SET page_talk_id = ?, page_title = ?, page_ns = ?,
-                page_is_redirect = ?
-            WHERE page_id = ?"""
-
-        query1 = query1.format(self._page_table, self._index_table)
-        query2 = query2.format(self._page_table)
-        query3 = query3.format(self._page_table)
-
-        # TODO: optimization candidates:
-        cursor.executemany(query1, to_remove)
-        cursor.executemany(query2, to_add)
-        cursor.executemany(query3, to_update)
-
-    def _sync_pageset(self, cursor, pages):
-        """Synchronize every page in the given list with the database."""
+            FROM {0}
+            JOIN {2} ON page_talk_id = talkid
+            LEFT JOIN {1} ON page_id = index_page {3}"""
+        query2 = """UPDATE {0}
+            JOIN {1} ON page_id = id
+            SET page_talk_id = talkid, page_title = title, page_ns = ns,
+                page_is_redirect = isredir"""
+
+        with self._get_writer(cursor) as writer:
+            if to_remove:
+                staged = writer.stage("removed_pages", [
+                    ("talkid", "INT(8) UNSIGNED NOT NULL PRIMARY KEY")
+                ], set(to_remove), phase="stage removed pages")
+                restrict = "AND index_project = ?" if project else ""
+                args = (project.id,) if project else ()
+                writer.execute(
+                    query1.format(self._page_table, self._index_table, staged,
+                                  restrict),
+                    args, phase="delete pages")
+
+            if to_add:
+                writer.insert(self._page_table, [
+                    "page_id", "page_talk_id", "page_title", "page_ns",
+                    "page_is_redirect"
+                ], to_add, phase="insert pages")
+
+            if to_update:
+                staged = writer.stage("updated_pages", [
+                    ("talkid", "INT(8) UNSIGNED NOT NULL"),
+                    ("title", "VARCHAR(255) NOT NULL"),
+                    ("ns", "INT(11) NOT NULL"),
+                    ("isredir", "TINYINT(1) UNSIGNED NOT NULL"),
+                    ("id", "INT(8) UNSIGNED NOT NULL PRIMARY KEY")
+                ], to_update, phase="stage updated pages")
+                writer.execute(query2.format(self._page_table, staged),
+                               phase="update pages")
+
+    def _sync_pageset(self, cursor, pages, project=None):
+        """Synchronize every page in the given list with the database.
+
+        *project* is passed to _save_modified_pages().
+        """
         query = """SELECT page_id, page_talk_id, page_title, page_ns,
                 page_is_redirect
             FROM {}
@@ -327,23 +680,22 @@ class UpdateProjectIndex(Task):
                 to_remove.append((page.talkid,))
                 to_add.append((page.id,) + new)
 
-        self._save_modified_pages(cursor, to_remove, to_add, to_update)
+        self._save_modified_pages(cursor, to_remove, to_add, to_update,
+                                  project)
 
-    def _sync_pages(self, cursor, processed, pages):
+    def _sync_pages(self, cursor, processed, pages, project=None):
         """Synchronize the given list of pages with the database.
 
         Pages whose IDs are in in the processed set are skipped. The other
-        pages are added to the set after processing.
+        pages are added to the set after processing. *project* is passed to
+        _save_modified_pages().
         """
         unprocessed = [page for page in pages if page.id not in processed]
         self._logger.debug("    %s unprocessed to check", len(unprocessed))
-        chunksize = 10000
-
-        for start in range(0, len(unprocessed), chunksize):
-            chunk = unprocessed[start:start+chunksize]
-            num = int(start / chunksize) + 1
+        chunks = chunked(unprocessed, self.CHUNKSIZE)
+        for num, chunk in enumerate(chunks, 1):
             self._logger.debug("    sync chunk #%s: %s pages", num, len(chunk))
-            self._sync_pageset(cursor, chunk)
+            self._sync_pageset(cursor, chunk, project)
 
         processed |= {page.id for page in unprocessed}
 
@@ -353,71 +705,446 @@ class UpdateProjectIndex(Task):
         cursor.execute(query.format(self._index_table), (project.id,))
         return [pageid for (pageid,) in cursor.fetchall()]
 
-    def _sync_index(self, cursor, project, newpages, oldids):
+    def _sync_index(self, cursor, project, newids, oldids):
         """Synchronize the index table for the given project."""
-        newids = [page.id for page in newpages]
-
         msg = "    sync index: %s -> %s (change: %s)"
         change = len(set(oldids) ^ set(newids))
         self._logger.debug(msg, len(oldids), len(newids), change)
 
-        query1 = "DELETE FROM {} WHERE index_page = ? AND index_project = ?"
-        query2 = "INSERT INTO {} (index_page, index_project) VALUES (?, ?)"
-
-        query1 = query1.format(self._index_table)
-        query2 = query2.format(self._index_table)
+        query = """DELETE {0}
+            FROM {0}
+            JOIN {1} ON index_page = pageid
+            WHERE index_project = ?"""
 
         to_remove = set(oldids) - set(newids)
         to_add = set(newids) - set(oldids)
 
-        # TODO: optimization candidates:
-        cursor.executemany(query1, [(pid, project.id) for pid in to_remove])
-        cursor.executemany(query2, [(pid, project.id) for pid in to_add])
+        with self._get_writer(cursor) as writer:
+            if to_remove:
+                staged = writer.stage("removed_index", [
+                    ("pageid", "INT(8) UNSIGNED NOT NULL PRIMARY KEY")
+                ], [(pid,) for pid in to_remove], phase="stage removed index")
+                writer.execute(query.format(self._index_table, staged),
+                               (project.id,), phase="delete index")
+
+            writer.insert(self._index_table, ["index_page", "index_project"],
+                          [(pid, project.id) for pid in to_add],
+                          phase="insert index")
 
     def _clear_old_pages(self, cursor, valid):
         """Remove all pages from the database that aren't in the given set."""
         self._logger.debug("Clearing old pages")
 
         query1 = "SELECT page_id FROM {}"
-        query2 = "DELETE FROM {} WHERE page_id = ?"
+        query2 = "DELETE {0} FROM {0} JOIN {1} ON page_id = pageid"
 
-        query1 = query1.format(self._page_table)
-        query2 = query2.format(self._page_table)
-
-        cursor.execute(query1)
+        cursor.execute(query1.format(self._page_table))
         current = {pageid for (pageid,) in cursor.fetchall()}
         to_remove = current - valid
         self._logger.debug("    remove: %s", len(to_remove))
+        if not to_remove:
+            return
+
+        with self._get_writer(cursor) as writer:
+            staged = writer.stage("old_pages", [
+                ("pageid", "INT(8) UNSIGNED NOT NULL PRIMARY KEY")
+            ], [(pageid,) for pageid in to_remove], phase="stage old pages")
+            writer.execute(query2.format(self._page_table, staged),
+                           phase="delete old pages")
 
-        # TODO: optimization candidate:
-        cursor.executemany(query2, [(pageid,) for pageid in to_remove])
+    def _write_project(self, conn, project, pages, newids):
+        """Write a single project's pages and index to the database.
 
-    def _sync_pages_and_index(self, projects):
-        """Synchronize the database's page and index tables."""
+        Concurrent writers can deadlock each other, so we retry the whole
+        transaction a few times if that happens.
+        """
+        for attempt in range(1, self.WRITE_ATTEMPTS + 1):
+            try:
+                with conn as cursor:
+                    cursor.execute("BEGIN")
+                    self._sync_pages(cursor, set(), pages, project)
+                    current = self._get_current_index(cursor, project)
+                    self._sync_index(cursor, project, newids, current)
+                return
+            except oursql.Error as exc:
+                if exc.errno != 1213 or attempt == self.WRITE_ATTEMPTS:
+                    raise
+                msg = "Deadlock writing %s; retrying (attempt %s)"
+                self._logger.warning(msg, project.title, attempt)
+
+    def _sync_worker(self, jobs, errors):
+        """Write projects from the given job queue until told to stop.
+
+        Each worker uses its own connection to the local database. If a write
+        fails, the exception is added to *errors* and remaining jobs are
+        skipped.
+        """
+        conn = self._bot.localdb
+        try:
+            while True:
+                job = jobs.get()
+                if job is None:
+                    break
+                if errors:
+                    continue
+                try:
+                    self._write_project(conn, *job)
+                except Exception as exc:
+                    self._logger.exception("Failed to write %s", job[0].title)
+                    errors.append(exc)
+        finally:
+            self._bot.release_connections()
+
+    def _sync_pages_and_index(self, projects, mark):
+        """Synchronize the database's page and index tables.
+
+        Reading from the replica happens on the main thread, while writing to
+        the local database is done by a pool of worker threads, so reads for
+        one project overlap with writes for previous ones. Each page is claimed
+        by the first project that contains it, so it is written exactly once
+        no matter which worker gets to it first.
+        """
         with self._bot.wikidb as cursor:
-            talkmap = self._get_talkmap(cursor)
+            talkmap = self._get_talkmap(cursor, mark)
+            members = self._get_memberships(cursor, talkmap, projects)
+
+        workers = self._workers
+        self._logger.info("Synchronizing pages and index (%s workers)",
+                          workers)
+
+        jobs = Queue(maxsize=workers)
+        errors = []
+        threads = [Thread(target=self._sync_worker, args=(jobs, errors),
+                          daemon=True) for _ in range(workers)]
+        for thread in threads:
+            thread.start()
 
-        self._logger.info("Synchronizing pages and index")
         processed = set()
+        try:
+            for project in projects:
+                if errors:
+                    break
+
+                self._logger.debug("Processing: %s", project.title)
+                talkids = set(members.pop(project.id))
+                newids = [talkmap[talkid] >> 1 for talkid in talkids]
+                unprocessed = [talkid for talkid in talkids
+                               if talkmap[talkid] >> 1 not in processed]
+                processed.update(talkmap[talkid] >> 1
+                                 for talkid in unprocessed)
+                self._logger.debug("    %s pages", len(talkids))
+
+                with self._bot.wikidb as cursor:
+                    pages = self._get_pages(cursor, talkmap, unprocessed)
+                jobs.put((project, pages, newids))
+        finally:
+            for _ in threads:
+                jobs.put(None)
+            for thread in threads:
+                thread.join()
+
+        if errors:
+            raise errors[0]
+
+        with self._bot.localdb as cursor:
+            cursor.execute("BEGIN")
+            self._clear_old_pages(cursor, processed)
 
-        for project in projects:
-            self._logger.debug("Processing: %s", project.title)
+    def _get_replica_time(self):
+        """Return the timestamp of the most recent change on the replica.
 
+        We use this instead of the current time as our high-water mark so that
+        replication lag can't cause us to skip over changes.
+        """
+        query = "SELECT MAX(rc_timestamp) FROM recentchanges"
+        with self._bot.wikidb as cursor:
+            cursor.execute(query)
+            timestamp = cursor.fetchall()[0][0]
+
+        if not timestamp:
+            return datetime.utcnow()
+        return datetime.strptime(timestamp.decode("utf8"), "%Y%m%d%H%M%S")
+
+    def _is_recent(self, since):
+        """Return whether recentchanges still covers the given time."""
+        return since >= datetime.utcnow() - self.MAX_INCREMENTAL_AGE
+
+    def _can_sync_changes(self, since):
+        """Return whether we can update incrementally from the given time."""
+        if self.FULL_REBUILD:
+            self._logger.info("Full rebuild requested")
+            return False
+        if since == datetime.min:
+            self._logger.info("No previous update; doing a full rebuild")
+            return False
+        if not self._is_recent(since):
+            msg = "Last update (%s) is too old; doing a full rebuild"
+            self._logger.info(msg, since)
+            return False
+        rebuilt = self._bot.get_last_updated(self.REBUILD_KEY)
+        if rebuilt < datetime.utcnow() - self._rebuild_interval:
+            msg = "Last full rebuild (%s) is too old; doing a full rebuild"
+            self._logger.info(msg, rebuilt)
+            return False
+        return True
+
+    def _get_changed_pages(self, cursor, catmap, since):
+        """Return a set of page IDs that may have changed since the given time.
+
+        This includes any page that was edited, created, moved, or deleted, and
+        any page added to a project category (directly or through a template).
+        Subject and talk page IDs are mixed together here.
+        """
+        query1 = """SELECT DISTINCT rc_cur_id
+            FROM recentchanges
+            WHERE rc_timestamp >= ? AND rc_cur_id != 0
+            AND rc_source IN ('mw.edit', 'mw.new', 'mw.log')"""
+        query2 = """SELECT DISTINCT cl_from
+            FROM categorylinks
+            WHERE cl_to IN ({}) AND cl_timestamp >= ?"""
+
+        cursor.execute(query1, (since.strftime("%Y%m%d%H%M%S"),))
+        changed = {pageid for (pageid,) in cursor.fetchall()}
+        self._logger.debug("%s pages in recentchanges", len(changed))
+
+        clts = since.strftime("%Y-%m-%d %H:%M:%S")
+        for chunk in chunked(list(catmap.keys()), 1000):
+            params = ", ".join("?" * len(chunk))
+            cursor.execute(query2.format(params), chunk + [clts])
+            changed |= {pageid for (pageid,) in cursor.fetchall()}
+
+        self._logger.debug("%s changed pages total", len(changed))
+        return changed
+
+    def _get_changed_talk_ids(self, cursor, changed, since):
+        """Return the talk page IDs that correspond to the given page IDs.
+
+        Talk page IDs are passed through; subject page IDs are converted into
+        their talk pages' IDs. Deleted pages are not included. We also include
+        talk pages whose subject pages appear in recentchanges by title since
+        the given time, which catches subject pages that were deleted.
+        """
+        query1 = """SELECT DISTINCT talk.page_id
+            FROM recentchanges
+            JOIN page AS talk ON talk.page_namespace = rc_namespace | 1
+                AND talk.page_title = rc_title
+            WHERE rc_timestamp >= ? AND rc_namespace >= 0
+            AND rc_source IN ('mw.edit', 'mw.new', 'mw.log')"""
+        query2 = """SELECT talk.page_id
+            FROM page AS subj
+            JOIN page AS talk ON talk.page_title = subj.page_title
+                AND talk.page_namespace = subj.page_namespace + 1
+            WHERE subj.page_namespace % 2 = 0 AND subj.page_id IN ({0})
+            UNION
+            SELECT page_id
+            FROM page
+            WHERE page_namespace % 2 = 1 AND page_id IN ({0})"""
+
+        cursor.execute(query1, (since.strftime("%Y%m%d%H%M%S"),))
+        talkids = {pageid for (pageid,) in cursor.fetchall()}
+
+        for chunk in chunked(list(changed), self.CHUNKSIZE):
+            params = ", ".join("?" * len(chunk))
+            cursor.execute(query2.format(params), chunk + chunk)
+            talkids |= {pageid for (pageid,) in cursor.fetchall()}
+        return talkids
+
+    def _get_talk_ids_in_project(self, cursor, project):
+        """Return the IDs of all pages in the given project's categories.
+
+        Talk pages are not filtered out here; that happens later.
+        """
+        query = """SELECT cl_from
+            FROM categorylinks
+            WHERE cl_type = "page" AND cl_to IN ({})"""
+
+        query = query.format(", ".join("?" * len(project.categories)))
+        cursor.execute(query, project.categories)
+        return {pageid for (pageid,) in cursor.fetchall()}
+
+    def _get_indexed_project_talk_ids(self, cursor, projectid):
+        """Return the talk page IDs of pages indexed under the given project.
+
+        This catches pages that left a project because one of its categories
+        did.
+        """
+        query = """SELECT page_talk_id
+            FROM {} JOIN {} ON index_page = page_id
+            WHERE index_project = ?"""
+
+        cursor.execute(query.format(self._page_table, self._index_table),
+                       (projectid,))
+        return {pageid for (pageid,) in cursor.fetchall()}
+
+    def _get_indexed_talk_ids(self, cursor, changed):
+        """Return talk page IDs in the database related to the given page IDs.
+
+        This catches pages that have been deleted or moved on the wiki, since
+        we still know about them under their old IDs.
+        """
+        query = """SELECT page_talk_id
+            FROM {0}
+            WHERE page_id IN ({1}) OR page_talk_id IN ({1})"""
+
+        talkids = set()
+        for chunk in chunked(list(changed), self.CHUNKSIZE):
+            params = ", ".join("?" * len(chunk))
+            cursor.execute(query.format(self._page_table, params),
+                           chunk + chunk)
+            talkids |= {pageid for (pageid,) in cursor.fetchall()}
+        return talkids
+
+    def _get_page_memberships(self, cursor, catmap, talkids):
+        """Return the current state of the given talk pages on the wiki.
+
+        The return value is a 2-tuple of (pages, members). *pages* maps talk
+        page IDs to Page objects, and *members* maps subject page IDs to sets
+        of project IDs. Talk pages that aren't in any project are omitted.
+        """
+        query = """SELECT talk.page_id, talk.page_namespace - 1,
+                talk.page_title, subj.page_id, subj.page_is_redirect, cl_to
+            FROM page AS talk
+            JOIN page AS subj ON subj.page_title = talk.page_title
+                AND subj.page_namespace = talk.page_namespace - 1
+            JOIN categorylinks ON cl_from = talk.page_id
+            WHERE cl_type = "page" AND talk.page_namespace % 2 = 1
+            AND talk.page_id IN ({})"""
+
+        pages = {}
+        members = {}
+
+        cursor.execute(query.format(", ".join("?" * len(talkids))), talkids)
+        for talkid, ns, title, pageid, isredir, cat in cursor.fetchall():
+            cat = cat.decode("utf8")
+            if cat not in catmap:
+                continue
+            if talkid not in pages:
+                pages[talkid] = Page(pageid, talkid, ns, title.decode("utf8"),
+                                     bool(isredir))
+                members[pageid] = set()
+            members[pageid].add(catmap[cat])
+
+        return pages, members
+
+    def _remove_pages(self, cursor, talkids):
+        """Remove the pages with the given talk page IDs from the database."""
+        self._logger.debug("    remove: %s", len(talkids))
+        if talkids:
+            self._save_modified_pages(
+                cursor, [(talkid,) for talkid in talkids], [], [])
+
+    def _sync_page_index(self, cursor, members):
+        """Synchronize the index table for the given pages.
+
+        *members* maps subject page IDs to the sets of project IDs that they
+        should belong to.
+        """
+        query1 = """SELECT index_page, index_project
+            FROM {}
+            WHERE index_page IN ({})"""
+        query2 = """DELETE {0}
+            FROM {0}
+            JOIN {1} ON index_page = pageid AND index_project = projectid"""
+
+        params = ", ".join("?" * len(members))
+        cursor.execute(query1.format(self._index_table, params),
+                       list(members.keys()))
+        old = set(cursor.fetchall())
+        new = {(pageid, projid) for pageid, projids in members.items()
+               for projid in projids}
+
+        to_remove = old - new
+        to_add = new - old
+        msg = "    sync index: remove/add: %s/%s"
+        self._logger.debug(msg, len(to_remove), len(to_add))
+
+        with self._get_writer(cursor) as writer:
+            if to_remove:
+                staged = writer.stage("removed_index", [
+                    ("pageid", "INT(8) UNSIGNED NOT NULL"),
+                    ("projectid", "INT(8) UNSIGNED NOT NULL")
+                ], to_remove, phase="stage removed index")
+                writer.execute(query2.format(self._index_table, staged),
+                               phase="delete index")
+
+            writer.insert(self._index_table, ["index_page", "index_project"],
+                          to_add, phase="insert index")
+
+    def _clear_unindexed_pages(self, cursor):
+        """Remove all pages from the database that aren't in any project."""
+        self._logger.debug("Clearing unindexed pages")
+
+        query = """DELETE {0}
+            FROM {0} LEFT JOIN {1} ON page_id = index_page
+            WHERE index_id IS NULL"""
+        cursor.execute(query.format(self._page_table, self._index_table))
+
+    def _sync_changes(self, projects, rescan, since):
+        """Synchronize the page and index tables with changes since a time.
+
+        Only talk pages that have changed since then are reprocessed, along
+        with every page of the projects in *rescan* (the IDs of projects that
+        are new or whose categories changed). Joining a category doesn't
+        change a page's cl_timestamp when the category itself is what's new
+        to the project.
+        """
+        self._logger.info("Synchronizing pages and index changed since %s",
+                          since)
+        catmap = {cat: proj.id for proj in projects for cat in proj.categories}
+
+        with self._bot.wikidb as cursor:
+            changed = self._get_changed_pages(cursor, catmap, since)
+            talkids = self._get_changed_talk_ids(cursor, changed, since)
+            for project in projects:
+                if project.id in rescan:
+                    self._logger.debug("Rescanning project: %s",
+                                       project.title)
+                    talkids |= self._get_talk_ids_in_project(cursor, project)
+
+        with self._bot.localdb as cursor:
+            talkids |= self._get_indexed_talk_ids(cursor, changed)
+            for pid in rescan:
+                talkids |= self._get_indexed_project_talk_ids(cursor, pid)
+
+        self._logger.info("%s talk pages to recheck", len(talkids))
+        chunks = chunked(sorted(talkids), self.CHUNKSIZE)
+        for num, chunk in enumerate(chunks, 1):
+            self._logger.debug("Recheck chunk #%s: %s pages", num, len(chunk))
             with self._bot.wikidb as cursor:
-                pages = self._get_pages_in_project(cursor, talkmap, project)
+                pages, members = self._get_page_memberships(
+                    cursor, catmap, chunk)
 
             with self._bot.localdb as cursor:
                 cursor.execute("BEGIN")
-                self._sync_pages(cursor, processed, pages)
-                current = self._get_current_index(cursor, project)
-                self._sync_index(cursor, project, pages, current)
+                self._remove_pages(cursor, set(chunk) - pages.keys())
+                if pages:
+                    self._sync_pageset(cursor, list(pages.values()))
+                    self._sync_page_index(cursor, members)
 
         with self._bot.localdb as cursor:
             cursor.execute("BEGIN")
-            self._clear_old_pages(cursor, processed)
+            self._clear_unindexed_pages(cursor)
 
     def run(self):
-        self._ensure_tables()
-        projects = self._get_projects()
-        self._sync_projects(projects)
-        self._sync_pages_and_index(projects)
+        created = self._ensure_tables()
+        mark = self._get_replica_time()
+        since = self._bot.get_last_updated(self.UPDATE_KEY)
+        if created:
+            since = datetime.min
+
+        projects = self._get_projects(since)
+        rescan = self._sync_projects(projects)
+
+        rebuilt = not self._can_sync_changes(since)
+        if rebuilt:
+            self._sync_pages_and_index(projects, mark)
+        else:
+            self._sync_changes(projects, rescan, since)
+
+        self._logger.info("Database writes:")
+        for phase, (rows, seconds) in self._write_stats.items():
+            self._logger.info("    %s: %s rows in %.2fs", phase, rows, seconds)
+
+        self._bot.set_last_updated(self.UPDATE_KEY, mark)
+        if rebuilt:
+            self._bot.set_last_updated(self.REBUILD_KEY, mark)